@@ -36,11 +36,39 @@ net_arg.add_argument('--w_size', type=int, default=5)
 
 # Data
 data_arg = add_argument_group('Data')
-data_arg.add_argument('--dataset', type=str, default='')
+data_arg.add_argument('--dataset', type=str, default='',
+                      help='directory in data_dir, or synthetic for random in-memory batches')
 data_arg.add_argument('--batch_size', type=int, default=8)
 data_arg.add_argument('--test_batch_size', type=int, default=100)
+data_arg.add_argument('--shuffle_buffer', type=int, default=1000,
+                      help='sample-level shuffle buffer of the latent code datasets (nn arch)')
 data_arg.add_argument('--num_worker', type=int, default=2)
+data_arg.add_argument('--loader', type=str, default='queue', choices=['queue', 'dataset', 'process'],
+                      help='FIFOQueue fed by loader threads, a tf.data pipeline, '
+                           'or FIFOQueue fed by decode processes')
+data_arg.add_argument('--autotune_loader', type=str2bool, default=False,
+                      help='adjust the number of loaders to the queue fill, starting at num_worker')
+data_arg.add_argument('--max_loader_threads', type=int, default=0, help='autotune limit, 0 is the cpu count')
+data_arg.add_argument('--prefetch', type=int, default=2, help='batches prefetched by the tf.data loader')
+data_arg.add_argument('--geom_format', type=str, default='float', choices=['float', 'label', 'quant'],
+                      help='geometry in the input queue: float32 probabilities, uint8 label map or uint8 quantized')
+data_arg.add_argument('--flip_axes', type=str, default='',
+                      help='3d augmentation: random per-sample flips along these axes, e.g. x or zyx')
+data_arg.add_argument('--permute_axes', type=str2bool, default=False,
+                      help='3d augmentation: random per-batch permutation of axes of equal size')
+data_arg.add_argument('--crop_jitter', type=int, default=0,
+                      help='3d augmentation: shift training crops by up to this many voxels (npz/packed stores)')
+data_arg.add_argument('--preflight', type=str2bool, default=False,
+                      help='check every sample before training, broken ones are quarantined')
+data_arg.add_argument('--pipeline_stats', type=str2bool, default=False,
+                      help='time the input pipeline stages, as pipeline/ summaries and model_dir/pipeline.jsonl')
+data_arg.add_argument('--loader_memory_mb', type=int, default=0,
+                      help='size queues/prefetch buffers to fit this budget, 0 keeps the fixed capacity')
 data_arg.add_argument('--data_type', type=str, default='velocity')
+data_arg.add_argument('--roi_cache', type=str2bool, default=False,
+                      help='crop 3d samples once and train from the cropped copies')
+data_arg.add_argument('--data_store', type=str, default='npz', choices=['npz', 'packed'],
+                      help='per-sample npz files or the memory-mapped store written by store.py')
 
 # Training / test parameters
 train_arg = add_argument_group('Training')
@@ -57,6 +85,16 @@ train_arg.add_argument('--lr_update', type=str, default='decay',
                        choices=['decay', 'step'])
 train_arg.add_argument('--phys_loss', type=str2bool, default=False)
 
+# Reference solver (solver.py)
+sim_arg = add_argument_group('Solver')
+sim_arg.add_argument('--sim_res', type=int, default=128)
+sim_arg.add_argument('--sim_spacing', type=float, default=0.1, help='voxel size, cm')
+sim_arg.add_argument('--sim_D_w', type=str, default='0.0002,0.015,5', help='min,max,num in cm^2/day')
+sim_arg.add_argument('--sim_rho', type=str, default='0.002,0.2,5', help='min,max,num in 1/day')
+sim_arg.add_argument('--sim_t', type=str, default='10,300,10', help='min,max,num in days')
+sim_arg.add_argument('--sim_anatomy', type=str, default='',
+                     help='npy of [res, res, res, 3] csf/wm/gm probabilities, empty for a synthetic brain')
+
 # Misc
 misc_arg = add_argument_group('Misc')
 misc_arg.add_argument('--log_dir', type=str, default='log')
@@ -67,6 +105,10 @@ misc_arg.add_argument('--code_path', type=str, default='')
 misc_arg.add_argument('--log_step', type=int, default=500)
 misc_arg.add_argument('--test_step', type=int, default=1000)
 misc_arg.add_argument('--save_sec', type=int, default=3600)
+misc_arg.add_argument('--latent_cache', type=int, default=16,
+                      help='anatomy latents kept by inference.TumorSurrogate')
+misc_arg.add_argument('--rank', type=int, default=0, help='index of this process in a multi-process run')
+misc_arg.add_argument('--world_size', type=int, default=1, help='number of processes sharing the dataset')
 misc_arg.add_argument('--random_seed', type=int, default=123)
 misc_arg.add_argument('--gpu_id', type=str, default='')
 
@@ -1,63 +1,127 @@
 import os
+import io
+import json
+import shutil
+import hashlib
 from glob import glob
 
 import threading
 import multiprocessing
 import signal
 import sys
+import time
+import itertools
 from datetime import datetime
+from queue import Empty
+from contextlib import nullcontext
 
 import tensorflow as tf
 import numpy as np
 import matplotlib.pyplot as plt
 
 from ops import *
+from manifest import manifest_path, read_manifest, read_args, is_current
+from store import crop_slices, load_dedup
+from stats import PipelineStats, STAGES
+
+# set by a BatchManager with --pipeline_stats, preprocess and the loaders time their stages into it
+pipeline_stats = None
+
+def stage(name):
+    return pipeline_stats.timer(name) if pipeline_stats is not None else nullcontext()
 
 class BatchManager(object):
     def __init__(self, config):
         self.rng = np.random.RandomState(config.random_seed)
         self.root = config.data_path        
 
-        # read data generation arguments
-        self.args = {}
-        with open(os.path.join(self.root, 'args.txt'), 'r') as f:
-            while True:
-                line = f.readline()
-                if not line:
-                    break
-                arg, arg_value = line[:-1].split(': ')
-                self.args[arg] = arg_value
-
         self.is_3d = config.is_3d
-        if 'ae' in config.arch:
-            def sortf(x):
-                nf = int(self.args['num_frames'])
-                n = os.path.basename(x)[:-4].split('_')
-                return int(n[0])*nf + int(n[1])
-
-            self.paths = sorted(glob("{}/{}/*".format(self.root, config.data_type[0])),
-                                key=sortf)
-            # num_path = len(self.paths)          
-            # num_train = int(num_path*0.95)
-            # self.test_paths = self.paths[num_train:]
-            # self.paths = self.paths[:num_train]
+        manifest = manifest_path(self.root, config.data_type)
+        header = None
+        if os.path.exists(manifest):
+            header, samples = read_manifest(manifest)
+            if not is_current(self.root, config.data_type, header):
+                print('%s: %s is stale (args.txt or the number of samples changed), '
+                      'rebuild it with manifest.py, using the files on disk' % (datetime.now(), manifest))
+                header = None
+        if header is not None:
+            # paths, args and the split of a previous build_manifest, no glob needed
+            self.args = header['args']
+            self.paths_training = [os.path.join(self.root, m['path']) for m in samples if m['split'] == 'train']
+            self.paths_validation = [os.path.join(self.root, m['path']) for m in samples if m['split'] == 'val']
+            self.paths = self.paths_training + self.paths_validation
+            self.num_samples = len(self.paths)
+            self.num_samples_training = len(self.paths_training)
+            self.num_samples_validation = len(self.paths_validation)
+            print('Using the split of', manifest)
         else:
-            self.paths = sorted(glob("{}/{}/*".format(self.root, config.data_type[0])))
-        
-        self.num_samples = len(self.paths)
-        assert(self.num_samples > 0)
+            # read data generation arguments
+            self.args = read_args(self.root)
+
+            if 'ae' in config.arch:
+                def sortf(x):
+                    nf = int(self.args['num_frames'])
+                    n = os.path.basename(x)[:-4].split('_')
+                    return int(n[0])*nf + int(n[1])
+
+                self.paths = sorted(glob("{}/{}/*".format(self.root, config.data_type[0])),
+                                    key=sortf)
+                # num_path = len(self.paths)          
+                # num_train = int(num_path*0.95)
+                # self.test_paths = self.paths[num_train:]
+                # self.paths = self.paths[:num_train]
+            else:
+                self.paths = sorted(glob("{}/{}/*".format(self.root, config.data_type[0])))
+            
+            self.num_samples = len(self.paths)
+            self.num_samples_training = int(0.9 * self.num_samples)
+            self.num_samples_validation = self.num_samples - self.num_samples_training
+            print('Using a split of 10% validation set, 90% training set')
+
+            # seeded, all ranks of a multi-process run have to agree on the split
+            np.random.RandomState(config.random_seed).shuffle(self.paths)
+            self.paths_training = self.paths[:self.num_samples_training]
+            self.paths_validation = self.paths[self.num_samples_training:]
+
+        self.rank = config.rank
+        self.world_size = config.world_size
+        if self.world_size > 1:
+            # every process reads a disjoint, fixed part of the training and validation split
+            assert(0 <= self.rank < self.world_size)
+            assert(len(self.paths_validation) >= self.world_size), 'fewer validation samples than processes'
+            self.paths_training = self.paths_training[self.rank::self.world_size]
+            self.paths_validation = self.paths_validation[self.rank::self.world_size]
+            self.paths = self.paths_training + self.paths_validation
+            self.num_samples = len(self.paths)
+            self.num_samples_training = len(self.paths_training)
+            self.num_samples_validation = len(self.paths_validation)
+            print('Shard %d of %d' % (self.rank, self.world_size))
+
+        # samples that failed to load in earlier runs (or the preflight scan) are left out
+        self.quarantine_path = os.path.join(self.root, config.data_type[0] + '_quarantine.txt')
+        self.quarantine_lock = threading.Lock()
+        self.num_skipped = 0
+        bad = read_quarantine(self.quarantine_path)
+        if config.preflight:
+            for path, err in scan_samples(self.paths, config.num_worker):
+                print('%s: preflight, %s is broken (%s)' % (datetime.now(), path, err))
+                self.quarantine(path, count=False)
+                bad.add(os.path.relpath(path, self.root))
+        if bad:
+            keep = lambda paths: [p for p in paths if os.path.relpath(p, self.root) not in bad]
+            self.paths_training = keep(self.paths_training)
+            self.paths_validation = keep(self.paths_validation)
+            self.paths = self.paths_training + self.paths_validation
+            print('%d quarantined samples left out, %d remain' % (
+                self.num_samples - len(self.paths), len(self.paths)))
+            self.num_samples = len(self.paths)
+            self.num_samples_training = len(self.paths_training)
+            self.num_samples_validation = len(self.paths_validation)
 
-        self.num_samples_training = int(0.9 * self.num_samples)
-        self.num_samples_validation = self.num_samples - self.num_samples_training
-        print('Using a split of 10% validation set, 90% training set')
+        assert(self.num_samples > 0)
         print('Total dataset size: ', self.num_samples)
         print('Training dataset size: ', self.num_samples_training)
 
-        np.random.shuffle(self.paths)
-        self.paths_training = self.paths[:self.num_samples_training]
-        self.paths_validation = self.paths[self.num_samples_training:]
-
-
         self.batch_size = config.batch_size
         self.epochs_per_step = self.batch_size / float(self.num_samples_training) # per epoch
 
@@ -74,9 +138,11 @@ class BatchManager(object):
         self.depth = depth
         self.c_num = int(self.args['num_param'])
 
+        self.geom_format = config.geom_format
+        self.geom_dtype = np.float32 if self.geom_format == 'float' else np.uint8
         if self.is_3d:
             feature_dim = [self.res_z, self.res_y, self.res_x, self.depth]
-            geom_dim = [self.res_z, self.res_y, self.res_x, 3]
+            geom_dim = [self.res_z, self.res_y, self.res_x, 1 if self.geom_format == 'label' else 3]
         else:
             feature_dim = [self.res_y, self.res_x, self.depth]
         
@@ -90,23 +156,33 @@ class BatchManager(object):
             min_after_dequeue = 500 #################
         else:
             min_after_dequeue = 5000
-        capacity = min_after_dequeue + 3 * self.batch_size
-        #self.q = tf.FIFOQueue(capacity, [tf.float32, tf.float32], [feature_dim, label_dim])
-        self.q = tf.FIFOQueue(capacity, [tf.float32, tf.float32, tf.float32], [feature_dim, label_dim, geom_dim])
-        self.x = tf.placeholder(dtype=tf.float32, shape=feature_dim)
-        #print("here               ",feature_dim, label_dim)
-        self.y = tf.placeholder(dtype=tf.float32, shape=label_dim)
-        self.geom = tf.placeholder(dtype=tf.float32, shape=geom_dim)
-        self.enqueue = self.q.enqueue([self.x, self.y, self.geom])
-        self.num_threads = np.amin([config.num_worker, multiprocessing.cpu_count(), self.batch_size])
-
-        self.q_val =tf.FIFOQueue(capacity, [tf.float32, tf.float32, tf.float32], [feature_dim, label_dim, geom_dim])
-        self.x_val = tf.placeholder(dtype=tf.float32, shape=feature_dim)
-        # print("here               ",feature_dim, label_dim)
-        self.y_val = tf.placeholder(dtype=tf.float32, shape=label_dim)
-        self.geom_val = tf.placeholder(dtype=tf.float32, shape=geom_dim)
-        self.enqueue_val = self.q_val.enqueue([self.x_val, self.y_val, self.geom_val])
+        self.capacity = min_after_dequeue + 3 * self.batch_size
+        self.feature_dim = feature_dim
+        self.label_dim = label_dim
+        self.geom_dim = geom_dim
+        self.dtypes = [np.float32, np.float32, self.geom_dtype]
+
+        self.loader = config.loader
+        self.seed = config.random_seed
+        self.prefetch = config.prefetch
+        if self.loader in ['dataset', 'process']:
+            # map calls / processes are not limited by the GIL-bound enqueue, so no batch_size cap
+            self.num_threads = np.amin([config.num_worker, multiprocessing.cpu_count()])
+        else:
+            self.num_threads = np.amin([config.num_worker, multiprocessing.cpu_count(), self.batch_size])
         self.num_threads_val = 1 #TODO: this is hardcoded for the time being
+        # autotune: queue loaders start at num_threads and move within [1, max_threads],
+        # tf.data picks its own parallelism
+        self.autotune = config.autotune_loader
+        self.max_threads = config.max_loader_threads or multiprocessing.cpu_count()
+        if self.autotune and self.loader == 'process':
+            print('autotune is not available for the process loader, using %d workers' % self.num_threads)
+            self.autotune = False
+
+        self.capacity_val = self.capacity
+        self.prefetch_val = self.prefetch
+        if config.loader_memory_mb > 0:
+            self.budget_buffers(config.loader_memory_mb)
 
         r = np.loadtxt(os.path.join(self.root, self.data_type[0]+'_range.txt'))
         self.x_range = max(abs(r[0]), abs(r[1]))
@@ -132,6 +208,196 @@ class BatchManager(object):
                 self.y_range.append([p_min, p_max])
                 self.y_num.append(p_num)
             print("initial_range", self.y_range)
+
+        self.crop = (self.res_z, self.res_y, self.res_x)
+        self.load = preprocess
+        if config.data_store == 'packed':
+            from store import PackedStore
+            self.store = PackedStore(os.path.join(self.root, 'packed', self.data_type[0]))
+            self.load = preprocess_packed(self.store)
+        if config.roi_cache and self.is_3d:
+            # read pre-cropped samples instead of the full volumes
+            cache_paths, failed = build_roi_cache(self.root, self.paths, self.data_type, self.x_range,
+                                                  self.y_range, self.crop, config.num_worker,
+                                                  'done_%d_of_%d.json' % (self.rank, self.world_size)
+                                                  if self.world_size > 1 else 'done.json')
+            # samples that could not be cached are quarantined under their source path
+            for path, err in failed:
+                print('%s: roi cache, %s is broken (%s)' % (datetime.now(), path, err))
+                self.quarantine(path, count=False)
+            cached = dict(zip(self.paths, cache_paths))
+            self.cache_source = {c: p for p, c in cached.items() if c is not None}
+            self.paths_training = [cached[p] for p in self.paths_training if cached[p] is not None]
+            self.paths_validation = [cached[p] for p in self.paths_validation if cached[p] is not None]
+            self.paths = [p for p in self.paths if cached[p] is not None]
+            self.num_samples = len(self.paths)
+            self.num_samples_training = len(self.paths_training)
+            self.num_samples_validation = len(self.paths_validation)
+            self.epochs_per_step = self.batch_size / float(self.num_samples_training)
+            self.load = preprocess_cached
+
+        # validation is a single pass, the last batch is padded with samples from the start
+        self.val_ids = one_pass(self.num_samples_validation, self.batch_size)
+        self.val_steps = self.val_ids.shape[0]
+        self.val_last = self.num_samples_validation - (self.val_steps-1)*self.batch_size
+
+        # augmentation, crop jitter happens in the training loaders, flips and permutations in-graph
+        self.crop_jitter = config.crop_jitter
+        self.flip_axes = config.flip_axes
+        self.permute_axes = config.permute_axes
+        if (self.crop_jitter or self.flip_axes or self.permute_axes) and not self.is_3d:
+            raise Exception("[!] augmentation is only implemented for 3d data")
+        if self.crop_jitter and self.load is preprocess_cached:
+            raise Exception("[!] roi cache holds fixed crops, crop_jitter needs --roi_cache=False")
+        if self.crop_jitter and os.path.isdir(os.path.join(self.root, 'anatomy')):
+            raise Exception("[!] dedup store holds fixed crops, crop_jitter needs the full volumes")
+        self.load_train = jitter_loader(self.load, self.crop_jitter) if self.crop_jitter else self.load
+
+        global pipeline_stats
+        if config.pipeline_stats:
+            pipeline_stats = PipelineStats(os.path.join(getattr(config, 'model_dir', self.root), 'pipeline.jsonl'))
+        self.pipeline_stats = pipeline_stats
+        self.trainer_wait = 0. # seconds the trainer waited for batches, with --pipeline_stats
+
+        if self.geom_format != 'float':
+            self.load = compact_loader(self.load, self.geom_format)
+            self.load_train = compact_loader(self.load_train, self.geom_format)
+
+        if self.loader == 'dataset':
+            self.build_dataset()
+        else:
+            self.build_queue()
+        if self.loader == 'process':
+            # started before the session exists, workers only ever run numpy code
+            self.pool = DecodePool(self.load_train, [self.feature_dim, self.label_dim, self.geom_dim],
+                                   self.dtypes, self.batch_size, self.num_threads, self.num_threads + 2,
+                                   (self.data_type, self.x_range, self.y_range, self.crop))
+
+    def budget_buffers(self, memory_mb):
+        # size the loader buffers from a memory budget instead of a fixed sample count
+        sample_bytes = sum(int(np.prod(d))*np.dtype(t).itemsize
+                           for d, t in zip([self.feature_dim, self.label_dim, self.geom_dim], self.dtypes))
+        num_samples = int(memory_mb * 2**20 // sample_bytes)
+
+        # samples held outside of the queues: batch buffers, process slots or running map calls.
+        # autotune may grow the loaders up to max_threads, each with its own buffers
+        num_loaders = self.max_threads if self.autotune else self.num_threads
+        if self.loader == 'process':
+            in_flight = (self.num_threads + 2 + self.num_threads_val) * self.batch_size
+        elif self.loader == 'dataset':
+            in_flight = num_loaders + self.batch_size
+        else:
+            in_flight = (num_loaders + self.num_threads_val) * self.batch_size
+
+        # validation only needs to stay ahead of the evaluation loop
+        self.capacity_val = 2 * self.batch_size
+        free = num_samples - in_flight - self.capacity_val
+        min_mb = (in_flight + self.capacity_val + 2*self.batch_size) * sample_bytes / 2.**20
+        assert free >= 2*self.batch_size, '[!] loader_memory_mb is too small, need at least %d' % np.ceil(min_mb)
+
+        self.capacity = free
+        self.prefetch = free // self.batch_size
+        self.prefetch_val = self.capacity_val // self.batch_size
+        print('%s: loader budget %d MB (%.1f MB/sample): %d samples in flight, queue %d, validation %d' % (
+            datetime.now(), memory_mb, sample_bytes / 2.**20, in_flight, self.capacity, self.capacity_val))
+
+    def build_queue(self):
+        feature_dim, label_dim, geom_dim = self.feature_dim, self.label_dim, self.geom_dim
+        geom_dtype = tf.as_dtype(self.geom_dtype)
+        #self.q = tf.FIFOQueue(capacity, [tf.float32, tf.float32], [feature_dim, label_dim])
+        self.q = tf.FIFOQueue(self.capacity, [tf.float32, tf.float32, geom_dtype], [feature_dim, label_dim, geom_dim])
+        # loaders push whole batches, one session call per batch
+        self.x = tf.placeholder(dtype=tf.float32, shape=[None] + feature_dim)
+        #print("here               ",feature_dim, label_dim)
+        self.y = tf.placeholder(dtype=tf.float32, shape=[None] + label_dim)
+        self.geom = tf.placeholder(dtype=geom_dtype, shape=[None] + geom_dim)
+        self.enqueue = self.q.enqueue_many([self.x, self.y, self.geom])
+        self.q_size_op = self.q.size()
+
+        self.q_val =tf.FIFOQueue(self.capacity_val, [tf.float32, tf.float32, geom_dtype], [feature_dim, label_dim, geom_dim])
+        self.x_val = tf.placeholder(dtype=tf.float32, shape=[None] + feature_dim)
+        # print("here               ",feature_dim, label_dim)
+        self.y_val = tf.placeholder(dtype=tf.float32, shape=[None] + label_dim)
+        self.geom_val = tf.placeholder(dtype=geom_dtype, shape=[None] + geom_dim)
+        self.enqueue_val = self.q_val.enqueue_many([self.x_val, self.y_val, self.geom_val])
+
+        # built here so that stopping works on a finalized graph
+        self.close_op = [self.q.close(cancel_pending_enqueues=True),
+                         self.q_val.close(cancel_pending_enqueues=True)]
+
+    def build_dataset(self):
+        # tf.data input pipeline: parallel map over file paths, batch and prefetch
+        self.num_loaded = 0
+        self.num_consumed = 0
+        self.count_lock = threading.Lock()
+
+        def loader(load_fn, paths, count=False, max_attempts=10):
+            rng = np.random.RandomState(self.seed)
+            def load(path):
+                path = path.decode()
+                failed = []
+                while True:
+                    try:
+                        with stage('load'):
+                            x, y, geom = load_fn(path, self.data_type, self.x_range, self.y_range, self.crop)
+                        break
+                    except Exception as e:
+                        # a random other sample takes the place of the broken one
+                        failed.append((path, e))
+                        if len(failed) >= max_attempts:
+                            raise Exception("[!] %d samples in a row failed to load, e.g. %s: %s" % (
+                                len(failed), path, e))
+                        if len(failed) > 1:
+                            # more than one failure in a row rather points to the storage, back off
+                            print('%s: %s (%d samples in a row)' % (datetime.now(), e, len(failed)))
+                            time.sleep(min(2**len(failed), 60))
+                        path = paths[rng.randint(len(paths))]
+                if len(failed) == 1:
+                    self.skip(*failed[0])
+                if count:
+                    with self.count_lock:
+                        self.num_loaded += 1
+                return x.astype(np.float32), y.astype(np.float32), geom.astype(self.geom_dtype)
+            return load
+
+        def set_shape(x, y, geom):
+            x.set_shape(self.feature_dim)
+            y.set_shape(self.label_dim)
+            geom.set_shape(self.geom_dim)
+            return x, y, geom
+
+        def consume(x, y, geom):
+            def count():
+                with self.count_lock:
+                    self.num_consumed += self.batch_size
+                return np.int32(self.num_loaded - self.num_consumed)
+            n = tf.py_func(count, [], tf.int32)
+            with tf.control_dependencies([n]):
+                return tf.identity(x), y, geom
+
+        def dataset(paths, count=False):
+            ds = tf.data.Dataset.from_tensor_slices(paths)
+            ds = ds.shuffle(len(paths), seed=self.seed, reshuffle_each_iteration=True).repeat()
+            return pipeline(ds, loader(self.load_train, paths, count), self.prefetch, count)
+
+        def val_dataset(paths):
+            # finite, one pass in a fixed order, re-initialized for every evaluation
+            ds = tf.data.Dataset.from_tensor_slices([paths[i] for i in self.val_ids.flatten()])
+            return pipeline(ds, loader(self.load, paths), self.prefetch_val)
+
+        def pipeline(ds, load, prefetch, count=False):
+            ds = ds.map(lambda p: tuple(tf.py_func(load, [p], [tf.as_dtype(t) for t in self.dtypes])),
+                        num_parallel_calls=tf.data.experimental.AUTOTUNE if self.autotune else self.num_threads)
+            ds = ds.map(set_shape)
+            ds = ds.batch(self.batch_size, drop_remainder=True)
+            ds = ds.prefetch(prefetch)
+            if count: ds = ds.map(consume)
+            return ds
+
+        self.it = dataset(self.paths_training, count=True).make_initializable_iterator()
+        self.it_val = val_dataset(self.paths_validation).make_initializable_iterator()
+        self.q_size = tf.py_func(lambda: np.int32(self.num_loaded - self.num_consumed), [], tf.int32)
+
     def __del__(self):
         try:
             self.stop_thread()
@@ -139,6 +405,13 @@ class BatchManager(object):
             pass
 
     def start_thread(self, sess):
+        if self.loader == 'dataset':
+            print('%s: start input pipeline with %s parallel calls' % (
+                datetime.now(), 'autotuned' if self.autotune else self.num_threads))
+            self.sess = sess
+            self.sess.run(self.it.initializer)
+            return
+
         print('%s: start to enque with %d threads' % (datetime.now(), self.num_threads + 1))
 
         # Main thread: create a coordinator.
@@ -147,47 +420,126 @@ class BatchManager(object):
 
 
         # Create a method for loading and enqueuing
-        def load_n_enqueue(sess, enqueue, coord, paths, rng,
-                           x, y, geom, data_type, x_range, y_range):
+        def load_n_enqueue(sess, enqueue, coord, paths, next_ids,
+                           x, y, geom, data_type, x_range, y_range, load):
+            # batch buffers, reused since the feed is copied on every run
+            x_ = np.empty([self.batch_size] + self.feature_dim, dtype=np.float32)
+            y_ = np.empty([self.batch_size] + self.label_dim, dtype=np.float32)
+            geom_ = np.empty([self.batch_size] + self.geom_dim, dtype=self.geom_dtype)
             with coord.stop_on_exception():                
+                failures = 0
                 while not coord.should_stop():
-                    #todo: we should find a method to sample data without replacement. This is more important for the validation set
-                    id = rng.randint(len(paths))
-                    x_, y_, geom_ = preprocess(paths[id], data_type, x_range, y_range)
+                    ids = next_ids()
+                    if ids is None:
+                        break
+                    # the same ids are retried, a validation pass must deliver all of its batches
+                    failed = None
+                    while failed is None and not coord.should_stop():
+                        try:
+                            failed = load_batch(load, [paths[id] for id in ids], [x_, y_, geom_],
+                                                (data_type, x_range, y_range, self.crop))
+                        except Exception as e:
+                            failures += 1
+                            self.batch_failed(e, failures)
+                    if failed is None:
+                        break
+                    failures = 0
+                    for path, err in failed:
+                        self.skip(path, err)
 
                     #geom_ = x_[...,1:]
                     #x_ = np.expand_dims(x_[..., 0], axis=3)
                     #print(x_.shape, y_.shape)
-                    sess.run(enqueue, feed_dict={x: x_, y: y_, geom: geom_})
-
-
+                    with stage('enqueue'):
+                        sess.run(enqueue, feed_dict={x: x_, y: y_, geom: geom_})
+
+        # Hand batches decoded by the process pool over to the queue
+        def feed_n_enqueue(sess, coord, pool, paths, sampler):
+            def submit(slot):
+                pool.submit(slot, [paths[i] for i in sampler.next(self.batch_size)])
+
+            with coord.stop_on_exception():
+                failures = 0
+                for slot in range(pool.num_slots):
+                    submit(slot)
+                while not coord.should_stop():
+                    try:
+                        slot, (x_, y_, geom_), failed, error, timing = pool.get(timeout=1)
+                    except Empty:
+                        continue
+                    if error is not None:
+                        failures += 1
+                        self.batch_failed(error, failures)
+                        submit(slot)
+                        continue
+                    failures = 0
+                    for path, err in failed:
+                        self.skip(path, err)
+                    if self.pipeline_stats is not None:
+                        self.pipeline_stats.merge(timing, 'decode-')
+                    with stage('enqueue'):
+                        sess.run(self.enqueue, feed_dict={self.x: x_, self.y: y_, self.geom: geom_})
+                    # the feed is copied by now, the slot can be refilled
+                    submit(slot)
+
+        def train_ids(sampler):
+            return lambda: sampler.next(self.batch_size)
+
+        # a single validation thread produces one whole pass per start_validation() call,
+        # in between it sleeps and leaves the cpu to the training loaders
+        self.val_request = threading.Semaphore(0)
+        def val_passes():
+            while True:
+                while not self.val_request.acquire(timeout=1):
+                    if self.coord.should_stop():
+                        yield None
+                for ids in self.val_ids:
+                    yield ids
+        val_ids = val_passes().__next__
+
+        if self.loader == 'process':
+            self.threads = [threading.Thread(target=feed_n_enqueue,
+                                             args=(self.sess, self.coord, self.pool, self.paths_training,
+                                                   EpochSampler(self.num_samples_training, self.seed)))]
+            num_loaders = 0
+        elif self.autotune:
+            # loaders share one sampler so that they can come and go, see autotune_loaders
+            self.threads = [threading.Thread(target=self.autotune_loaders,
+                                             args=(load_n_enqueue, EpochSampler(self.num_samples_training, self.seed)))]
+            num_loaders = 0
+        else:
+            self.threads = []
+            num_loaders = self.num_threads
 
-        # Create threads that enqueue
-        self.threads = [threading.Thread(target=load_n_enqueue, 
+        # Create threads that enqueue, each one reads its own shard of every epoch
+        self.threads += [threading.Thread(target=load_n_enqueue, 
                                           args=(self.sess, 
                                                 self.enqueue,
                                                 self.coord,
                                                 self.paths_training,
-                                                self.rng,
+                                                train_ids(EpochSampler(self.num_samples_training, self.seed,
+                                                                       shard=i, num_shards=num_loaders)),
                                                 self.x,
                                                 self.y,
                                                 self.geom,
                                                 self.data_type,
                                                 self.x_range,
-                                                self.y_range)
-                                          ) for i in range(self.num_threads)] + [
+                                                self.y_range,
+                                                self.load_train)
+                                          ) for i in range(num_loaders)] + [
                         threading.Thread(target=load_n_enqueue,
                                                       args=(self.sess,
                                                             self.enqueue_val,
                                                             self.coord,
                                                             self.paths_validation,
-                                                            self.rng,
+                                                            val_ids,
                                                             self.x_val,
                                                             self.y_val,
                                                             self.geom_val,
                                                             self.data_type,
                                                             self.x_range,
-                                                            self.y_range)
+                                                            self.y_range,
+                                                            self.load)
                                                       ) for i in range(self.num_threads_val)]
 
         # define signal handler
@@ -196,8 +548,7 @@ class BatchManager(object):
             #saver.save(sess, "./checkpoints/VDSR_norm_clip_epoch_%03d.ckpt" % epoch ,global_step=global_step)
             print('%s: canceled by SIGINT' % datetime.now())
             self.coord.request_stop()
-            self.sess.run(self.q.close(cancel_pending_enqueues=True))
-            self.sess.run(self.q_val.close(cancel_pending_enqueues=True))
+            self.sess.run(self.close_op)
             self.coord.join(self.threads)
             sys.exit(1)
         signal.signal(signal.SIGINT, signal_handler)
@@ -206,22 +557,173 @@ class BatchManager(object):
         for t in self.threads:
             t.start()
 
+    def autotune_loaders(self, load_n_enqueue, sampler, interval=10, num_probes=20, max_wait=0.05):
+        # add a loader while the trainer waits for batches, drop one while the queue stays nearly full.
+        # the wait is measured with --pipeline_stats, otherwise it is guessed from an empty queue
+        stops = []
+        def add_loader():
+            stop = threading.Event()
+            next_ids = lambda: None if stop.is_set() else sampler.next(self.batch_size)
+            t = threading.Thread(target=load_n_enqueue,
+                                 args=(self.sess, self.enqueue, self.coord, self.paths_training, next_ids,
+                                       self.x, self.y, self.geom, self.data_type, self.x_range, self.y_range,
+                                       self.load_train))
+            t.start()
+            self.threads.append(t)
+            stops.append(stop)
+
+        for _ in range(self.num_threads):
+            add_loader()
+        with self.coord.stop_on_exception():
+            while not self.coord.should_stop():
+                fill = []
+                start, self.trainer_wait = time.time(), 0.
+                for _ in range(num_probes):
+                    if self.coord.wait_for_stop(interval / num_probes):
+                        break
+                    fill.append(self.sess.run(self.q_size_op) / float(self.capacity))
+                if len(fill) < num_probes:
+                    break
+                if self.pipeline_stats is not None:
+                    # fraction of the interval the trainer spent in dequeue
+                    starved = self.trainer_wait / (time.time() - start)
+                    busy, idle = starved > max_wait, starved < 0.1*max_wait
+                else:
+                    starved = np.mean(np.array(fill) * self.capacity < self.batch_size)
+                    busy, idle = starved > 0.1, starved == 0
+                n = len(stops)
+                if busy and n < self.max_threads:
+                    add_loader()
+                elif idle and np.min(fill) > 0.75 and n > 1:
+                    stops.pop().set()
+                if len(stops) != n:
+                    print('%s: autotune, queue %.0f%% full, starved %.0f%% of the time, %d -> %d loaders' % (
+                        datetime.now(), 100*np.mean(fill), 100*starved, n, len(stops)))
+        self.num_threads = len(stops)
+        print('%s: autotune ended with %d loaders, pin with --num_worker %d' % (
+            datetime.now(), self.num_threads, self.num_threads))
+
+    def quarantine(self, path, count=True):
+        path = getattr(self, 'cache_source', {}).get(path, path) # roi cache files stand for their source
+        with self.quarantine_lock:
+            if count:
+                self.num_skipped += 1
+            with open(self.quarantine_path, 'a') as f:
+                f.write(os.path.relpath(path, self.root) + '\n')
+
+    def skip(self, path, err):
+        # a sample failed to load, it is replaced in its batch and left out of future runs
+        print('%s: skip %s (%s)' % (datetime.now(), path, err))
+        self.quarantine(path)
+
+    def batch_failed(self, err, failures, max_failures=10):
+        # no sample of a batch could be loaded (e.g. the storage is gone), retried with backoff.
+        # in the end the queues are closed, so the trainer fails instead of waiting in dequeue forever
+        print('%s: %s (%d batches in a row)' % (datetime.now(), err, failures))
+        if failures >= max_failures:
+            self.sess.run(self.close_op)
+            raise Exception("[!] %d batches in a row failed to load, input pipeline stopped" % failures)
+        self.coord.wait_for_stop(min(2**failures, 60))
+
+    def skipped(self):
+        # number of samples replaced since the start, as a tensor for summaries
+        return tf.py_func(lambda: np.int32(self.num_skipped), [], tf.int32)
+
     def stop_thread(self):
-        # dirty way to bypass graph finilization error
-        g = tf.get_default_graph()
-        g._finalized = False
+        if self.loader == 'dataset':
+            return
 
         self.coord.request_stop()
-        self.sess.run(self.q.close(cancel_pending_enqueues=True))
-        self.sess.run(self.q_val.close(cancel_pending_enqueues=True))
+        self.sess.run(self.close_op)
         self.coord.join(self.threads)
+        if self.loader == 'process':
+            self.pool.close()
+
+    def start_validation(self):
+        # call before running val_steps validation batches
+        if self.loader == 'dataset':
+            self.sess.run(self.it_val.initializer)
+        else:
+            self.val_request.release()
 
     def batch(self):
+        if self.pipeline_stats is not None:
+            # time from asking for a batch until it is there, i.e. how long the trainer waits
+            start = tf.py_func(time.time, [], tf.float64)
+            with tf.control_dependencies([start]):
+                x, y, geom = self.dequeue()
+            def waited(t):
+                dt = time.time() - t
+                self.pipeline_stats.add('dequeue_wait', dt, 'trainer')
+                self.trainer_wait += dt # read and reset by autotune_loaders
+                return t
+            with tf.control_dependencies([x, y, geom]):
+                end = tf.py_func(waited, [start], tf.float64)
+            with tf.control_dependencies([end]):
+                x, y, geom = tf.identity(x), tf.identity(y), tf.identity(geom)
+        else:
+            x, y, geom = self.dequeue()
+        if self.flip_axes or self.permute_axes:
+            x, geom = self.augment(x, geom)
+        return x, y, geom
+
+    def dequeue(self):
+        if self.loader == 'dataset':
+            return self.it.get_next()
         return self.q.dequeue_many(self.batch_size)
 
+    def stats_summaries(self):
+        # mean ms per call of every pipeline stage since the last summary, also appended to pipeline.jsonl
+        if self.pipeline_stats is None:
+            return []
+        mean_ms = tf.py_func(self.pipeline_stats.report, [], tf.float32)
+        return [tf.summary.scalar('pipeline/%s_ms' % k, mean_ms[i]) for i, k in enumerate(STAGES)]
+
+    def augment(self, x, geom):
+        # whole-batch augmentation of [b, z, y, x, c] tensors, concentration and geometry alike.
+        # the diffusion model is isotropic, so the labels are not affected.
+        axis = {'z': 1, 'y': 2, 'x': 3}
+        b = tf.shape(x)[0]
+        for a in self.flip_axes:
+            # per sample, 'x' is the left-right (hemisphere) mirror
+            flip = tf.random_uniform([b]) < 0.5
+            x = tf.where(flip, tf.reverse(x, [axis[a]]), x)
+            geom = tf.where(flip, tf.reverse(geom, [axis[a]]), geom)
+
+        if self.permute_axes:
+            # per batch, only axes of the same size are exchanged
+            dims = self.feature_dim[:3]
+            perms = [p for p in itertools.permutations([0, 1, 2])
+                     if [dims[i] for i in p] == dims]
+            k = tf.random_uniform([], 0, len(perms), dtype=tf.int32)
+            def transpose(p):
+                t = [0] + [i+1 for i in p] + [4]
+                return lambda: (tf.transpose(x, t), tf.transpose(geom, t))
+            x, geom = tf.case([(tf.equal(k, i), transpose(p)) for i, p in enumerate(perms)],
+                              exclusive=True)
+            x.set_shape([None] + self.feature_dim)
+            geom.set_shape([None] + self.geom_dim)
+        return x, geom
+
     def batch_val(self):
+        if self.loader == 'dataset':
+            return self.it_val.get_next()
         return self.q_val.dequeue_many(self.batch_size)
 
+    def queue_size(self):
+        # number of loaded samples waiting for the trainer
+        if self.loader == 'dataset':
+            return self.q_size
+        return self.q.size()
+
+    def queue_fill(self):
+        # fraction of the loader buffer in use, close to 0 means the trainer waits for data
+        if self.loader == 'dataset':
+            capacity = self.prefetch * self.batch_size
+        else:
+            capacity = self.capacity
+        return tf.cast(self.queue_size(), tf.float32) / capacity
+
     def batch_(self, b_num):
         assert(len(self.paths) % b_num == 0)
         x_batch = []
@@ -328,7 +830,8 @@ class BatchManager(object):
             #print("p-------", p)
             file_path = self.list_from_p([p])[0]
             #print(file_path)
-            x, y, geom = preprocess(file_path, self.data_type, self.x_range, self.y_range)
+            x, y, geom = preprocess(file_path, self.data_type, self.x_range, self.y_range, self.crop)
+            geom = compact_geom(geom, self.geom_format)
             #x = np.expand_dims(x[..., 0], axis=3)
             sample['x'].append(x)
             sample['y'].append(y)
@@ -383,12 +886,282 @@ class BatchManager(object):
             return self.random_list2d(num)
     
 
-def preprocess(file_path, data_type, x_range, y_range):
+class SyntheticBatchManager(BatchManager):
+    """--dataset synthetic: normalized random 3d batches kept in graph variables.
+    no files, no loader threads, for timing the trainers without the input pipeline."""
+    def __init__(self, config, num_batches=4):
+        if not config.is_3d:
+            raise Exception("[!] synthetic data is only implemented for 3d")
+        self.root = config.data_path
+        self.is_3d = True
+        self.data_type = config.data_type
+        self.batch_size = config.batch_size
+        self.loader = 'synthetic'
+        self.seed = config.random_seed
+        self.pipeline_stats = None
+        self.num_skipped = 0
+
+        self.res_x, self.res_y, self.res_z = config.res_x, config.res_y, config.res_z
+        self.depth = 1
+        self.c_num = 3 # D_w, rho, t
+        self.crop = (self.res_z, self.res_y, self.res_x)
+        self.geom_format = config.geom_format
+        self.geom_dtype = np.float32 if self.geom_format == 'float' else np.uint8
+        self.feature_dim = [self.res_z, self.res_y, self.res_x, self.depth]
+        self.geom_dim = [self.res_z, self.res_y, self.res_x, 1 if self.geom_format == 'label' else 3]
+        self.label_dim = [self.c_num]
+        self.x_range = 1. # samples are generated normalized
+        self.y_range = [[-1, 1]] * self.c_num
+        self.y_num = [1] * self.c_num
+
+        self.num_batches = num_batches
+        self.num_samples_training = num_batches * self.batch_size
+        self.num_samples_validation = self.batch_size
+        self.num_samples = self.num_samples_training + self.num_samples_validation
+        self.epochs_per_step = self.batch_size / float(self.num_samples_training)
+        self.val_ids = one_pass(self.num_samples_validation, self.batch_size)
+        self.val_steps = self.val_ids.shape[0]
+        self.val_last = self.batch_size
+
+        # generated in-graph, the graph (and its dump in model_dir) holds no data.
+        # local variables: initialized by the supervisor, but not written to checkpoints
+        samples = synthetic_samples(self.num_samples, self.feature_dim, self.c_num, self.data_type,
+                                    self.geom_format, self.seed)
+        self.batches = [tf.Variable(tf.reshape(a, [num_batches + 1, self.batch_size] + get_conv_shape(a)[1:]),
+                                    trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                        for a in samples]
+        print('%s: synthetic data, %d training batches of %s' % (datetime.now(), num_batches, self.feature_dim))
+
+    def start_thread(self, sess):
+        self.sess = sess
+
+    def stop_thread(self):
+        pass
+
+    def start_validation(self):
+        pass
+
+    def dequeue(self):
+        k = tf.random_uniform([], 0, self.num_batches, dtype=tf.int32)
+        return tuple(b[k] for b in self.batches)
+
+    def batch(self):
+        return self.dequeue()
+
+    def batch_val(self):
+        # the last batch is held out
+        return tuple(b[self.num_batches] for b in self.batches)
+
+    def queue_size(self):
+        return tf.constant(self.num_samples_training)
+
+    def queue_fill(self):
+        return tf.constant(1.)
+
+    def list_from_p(self, p_list):
+        return ['synthetic'] * len(p_list)
+
+    def random_list(self, num, z_samples=None):
+        x, y, geom = [a.reshape([-1] + list(a.shape[2:]))[:num] for a in self.sess.run(self.batches)]
+        sample = {'x': x, 'y': y, 'geom': geom}
+        for k, xy_plane, project in [('xy', True, True), ('zy', False, True),
+                                     ('xym', True, False), ('zym', False, False)]:
+            sample[k] = np.array([plane_view_np(xi, xy_plane=xy_plane, project=project) for xi in x])
+        sample['p'] = [[0]*6 for _ in range(num)]
+        sample['z'] = y.tolist()
+        return sample
+
+def synthetic_samples(num, feature_dim, c_num, data_type, geom_format, seed):
+    # normalized samples: a gaussian tumor of random position and width in random tissue
+    grid = tf.meshgrid(*[tf.linspace(-1., 1., n) for n in feature_dim[:3]], indexing='ij')
+    center = tf.random_uniform([num, 3], -0.3, 0.3, seed=seed)
+    width = tf.random_uniform([num, 1, 1, 1], 0.1, 0.4, seed=seed+1)
+    r2 = tf.add_n([(g - center[:, i, None, None, None])**2 for i, g in enumerate(grid)])
+    x = tf.expand_dims(tf.exp(-r2 / (2*width**2)), -1)
+    if data_type[0] == 'd':
+        x = x*2 - 1
+    y = tf.random_uniform([num, c_num], -1, 1, seed=seed+2)
+
+    tissue = tf.random_uniform(feature_dim[:3] + [4], seed=seed+3) # background, wm, gm, csf
+    tissue /= tf.reduce_sum(tissue, axis=-1, keepdims=True)
+    if geom_format == 'label':
+        geom = tf.expand_dims(tf.cast(tf.argmax(tissue, axis=-1), tf.uint8), -1)
+    elif geom_format == 'quant':
+        geom = tf.cast(tf.round(tissue[..., 1:]*255), tf.uint8)
+    else:
+        geom = tissue[..., 1:]
+    geom = tf.tile(tf.expand_dims(geom, 0), [num, 1, 1, 1, 1])
+    return x, y, geom
+
+class EpochSampler(object):
+    """sample indices in shuffled epochs, without replacement.
+    the order of an epoch only depends on (seed, epoch), shard k of n takes
+    every n-th index of it, so the loader workers split each epoch."""
+    def __init__(self, num_samples, seed, shard=0, num_shards=1, shuffle=True):
+        assert(num_samples >= num_shards)
+        self.num_samples = num_samples
+        self.seed = seed
+        self.shard = shard
+        self.num_shards = num_shards
+        self.shuffle = shuffle
+        self.lock = threading.Lock()
+        self.epoch = 0
+        self.pos = 0
+        self.order = self.epoch_order(0)
+
+    def epoch_order(self, epoch):
+        if self.shuffle:
+            order = np.random.RandomState([self.seed, epoch]).permutation(self.num_samples)
+        else:
+            order = np.arange(self.num_samples)
+        return order[self.shard::self.num_shards]
+
+    def next(self, n):
+        # next n indices, continues into the following epoch
+        with self.lock:
+            ids = []
+            while len(ids) < n:
+                if self.pos == len(self.order):
+                    self.epoch += 1
+                    self.pos = 0
+                    self.order = self.epoch_order(self.epoch)
+                k = min(n - len(ids), len(self.order) - self.pos)
+                ids.extend(self.order[self.pos:self.pos+k])
+                self.pos += k
+            return ids
+
+def one_pass(num_samples, batch_size):
+    # [num_batches, batch_size] indices visiting every sample once,
+    # the last batch is filled up with samples from the start
+    num_batches = int(np.ceil(num_samples / float(batch_size)))
+    return (np.arange(num_batches*batch_size) % num_samples).reshape(num_batches, batch_size)
+
+def _decode_worker(load, buffers, shapes, dtypes, tasks, done, load_args):
+    global pipeline_stats
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent handles ctrl-c
+    np.random.seed() # forked workers would share the parent's crop jitter otherwise
+    # timed per process, the totals go back with every batch
+    timing = pipeline_stats = PipelineStats() if pipeline_stats is not None else None
+    done.cancel_join_thread()
+    views = [np.frombuffer(b, dtype=t).reshape([-1]+s) for b, s, t in zip(buffers, shapes, dtypes)]
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, paths = task
+        try:
+            failed, error = load_batch(load, paths, [v[slot] for v in views], load_args), None
+        except Exception as e:
+            failed, error = [], repr(e)
+        done.put((slot, [(path, repr(err)) for path, err in failed], error,
+                  timing.take() if timing is not None else {}))
+
+class DecodePool(object):
+    """worker processes decoding whole batches into shared memory slots.
+    only slot ids and paths go through the queues, the arrays are never pickled."""
+    def __init__(self, load, shapes, dtypes, batch_size, num_workers, num_slots, load_args):
+        self.num_slots = num_slots
+        typecode = {'float32': 'f', 'uint8': 'B'}
+        self.buffers = [multiprocessing.RawArray(typecode[np.dtype(t).name], num_slots*batch_size*int(np.prod(s)))
+                        for s, t in zip(shapes, dtypes)]
+        self.views = [np.frombuffer(b, dtype=t).reshape([num_slots, batch_size]+s)
+                      for b, s, t in zip(self.buffers, shapes, dtypes)]
+        self.tasks = multiprocessing.Queue()
+        self.done = multiprocessing.Queue()
+        self.procs = [multiprocessing.Process(target=_decode_worker,
+                                              args=(load, self.buffers, [[batch_size]+s for s in shapes], dtypes,
+                                                    self.tasks, self.done, load_args))
+                      for _ in range(num_workers)]
+        for p in self.procs:
+            p.daemon = True
+            p.start()
+
+    def submit(self, slot, paths):
+        self.tasks.put((slot, paths))
+
+    def get(self, timeout=None):
+        # slot, its arrays, the (path, error) of samples that were replaced, the error if the
+        # whole batch failed and the worker's stage timing
+        slot, failed, error, timing = self.done.get(timeout=timeout)
+        return slot, [v[slot] for v in self.views], failed, error, timing
+
+    def close(self):
+        for _ in self.procs:
+            self.tasks.put(None)
+        for p in self.procs:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+
+def load_batch(load, paths, out, load_args):
+    """load paths into the rows of the out arrays. samples that fail are replaced by
+    copies of loaded ones of the same batch, returns the (path, error) of the failures"""
+    failed, loaded = [], []
+    for i, path in enumerate(paths):
+        try:
+            with stage('load'):
+                sample = load(path, *load_args)
+            for o, d in zip(out, sample):
+                o[i] = d
+            loaded.append(i)
+        except Exception as e:
+            failed.append((i, path, e))
+    if failed and not loaded:
+        raise Exception("[!] every sample of a batch failed to load, e.g. %s: %s" % failed[0][1:])
+    for k, (i, _, _) in enumerate(failed):
+        j = loaded[k % len(loaded)]
+        for o in out:
+            o[i] = o[j]
+    return [(path, e) for _, path, e in failed]
+
+def read_quarantine(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
+
+def _check_sample(path):
+    # full decompression of every array (catches truncated files and crc errors) plus a nan check
+    try:
+        with np.load(path) as data:
+            for k in data.files:
+                a = data[k]
+                if a.dtype.kind == 'f' and not np.all(np.isfinite(a)):
+                    raise ValueError('non-finite values in %s' % k)
+        return None
+    except Exception as e:
+        return repr(e)
+
+def scan_samples(paths, num_worker=1):
+    """parallel integrity check, returns the (path, error) of broken samples"""
+    print('%s: preflight scan of %d samples' % (datetime.now(), len(paths)))
+    pool = multiprocessing.Pool(max(num_worker, 1))
+    try:
+        errors = pool.map(_check_sample, paths, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    return [(p, e) for p, e in zip(paths, errors) if e is not None]
+
+def preprocess(file_path, data_type, x_range, y_range, crop=(64,64,64), jitter=0):
     #print(file_path)
-    with np.load(file_path) as data:
-        y = data['y']
-        x = np.expand_dims(data['x'][..., 0][int(round(y[3]*128))-32:int(round(y[3]*128))+32,int(round(y[4]*128))-32:int(round(y[4]*128))+32,int(round(y[5]*128))-32:int(round(y[5]*128))+32], axis=3)
-        geom = data['x'][...,1:][int(round(y[3]*128))-32:int(round(y[3]*128))+32,int(round(y[4]*128))-32:int(round(y[4]*128))+32,int(round(y[5]*128))-32:int(round(y[5]*128))+32]
+    # the file is read in one go, so that disk and decompression time can be told apart
+    with stage('read'):
+        with open(file_path, 'rb') as f:
+            raw = io.BytesIO(f.read())
+    with np.load(raw) as data:
+        if 'anatomy' in data.files:
+            # deduplicated store, the geometry comes from the shared anatomy (fixed window, no jitter)
+            with stage('decompress'):
+                x, y, geom = load_dedup(file_path, data, crop)
+        else:
+            with stage('decompress'):
+                y = data['y']
+                volume = data['x']
+            with stage('crop'):
+                s = crop_slices(y, crop, res=volume.shape[0], shift=random_shift(jitter))
+                x = np.expand_dims(volume[..., 0][s], axis=3)
+                geom = volume[...,1:][s]
         y=y[:3]
 
         #print("initial ",  y , "final ", y[2])
@@ -406,17 +1179,150 @@ def preprocess(file_path, data_type, x_range, y_range):
     # else:
     #     x = x[::-1] # horizontal flip
 
-    # normalize
+    with stage('normalize'):
+        x, y = normalize(x, y, data_type, x_range, y_range)
+    return x, y, geom
+
+def normalize(x, y, data_type, x_range, y_range):
+    # x and y may be read-only views (memmap), so nothing is done in place
     if data_type[0] == 'd':
         x = x*2 - 1
     else:
-        x /= x_range
+        x = x / x_range
     #print("preprocess_range", y_range, y)
+    y = np.array(y, dtype=np.float64)
     for i, ri in enumerate(y_range):
         y[i] = (y[i]-ri[0]) / (ri[1]-ri[0]) * 2 - 1
         #y[i] = y[i]/ri[1]
     #print("processed", y)
-    return x, y, geom
+    return x, y
+
+def preprocess_packed(store):
+    # loader reading from a store.PackedStore, crops are views into the mapped file
+    def load(file_path, data_type, x_range, y_range, crop=(64,64,64), jitter=0):
+        x, geom, y = store.sample(file_path)
+        s = crop_slices(y, crop, res=x.shape[0], shift=random_shift(jitter))
+        with stage('normalize'):
+            x, y = normalize(x[s], y[:3], data_type, x_range, y_range)
+        return x, y, geom[s]
+    return load
+
+def random_shift(jitter):
+    if jitter == 0:
+        return None
+    return np.random.randint(-jitter, jitter+1, size=3)
+
+def jitter_loader(load, jitter):
+    # training loads move the crop window by up to jitter voxels around the tumor center
+    def load_jittered(*args):
+        return load(*args, jitter=jitter)
+    return load_jittered
+
+def compact_geom(geom, geom_format):
+    # 'label': uint8 tissue label map, 0 is background and k+1 the most probable channel k
+    # 'quant': uint8 probabilities in 1/255 steps
+    # both are expanded again in-graph by ops.decode_geom
+    if geom_format == 'label':
+        background = 1 - np.sum(geom, axis=-1, keepdims=True)
+        return np.argmax(np.concatenate((background, geom), axis=-1), axis=-1)[..., None].astype(np.uint8)
+    elif geom_format == 'quant':
+        return np.uint8(np.clip(np.round(geom*255), 0, 255))
+    return geom
+
+def compact_loader(load, geom_format):
+    def load_compact(*args):
+        x, y, geom = load(*args)
+        return x, y, compact_geom(geom, geom_format)
+    return load_compact
+
+def preprocess_cached(file_path, data_type, x_range, y_range, crop=None):
+    # samples written by build_roi_cache are already cropped and normalized
+    with np.load(file_path) as data:
+        return data['x'], data['y'], data['geom']
+
+def roi_cache_key(root, data_type, crop):
+    # anything that changes the content of a cached sample goes into the key
+    h = hashlib.sha1()
+    for name in ['args.txt', data_type[0]+'_range.txt']:
+        with open(os.path.join(root, name), 'rb') as f:
+            h.update(f.read())
+    h.update(str([data_type, list(crop)]).encode())
+    return h.hexdigest()[:16]
+
+def _cache_sample(job):
+    # returns the error of a sample that cannot be loaded, the cache is built without it
+    src, dst, data_type, x_range, y_range, crop = job
+    try:
+        x, y, geom = preprocess(src, data_type, x_range, y_range, crop)
+    except Exception as e:
+        return repr(e)
+    np.savez_compressed(dst, x=x.astype(np.float32), y=y.astype(np.float32),
+                        geom=geom.astype(np.float32))
+
+def build_roi_cache(root, paths, data_type, x_range, y_range, crop, num_worker=1, done_name='done.json'):
+    """crop every sample once around its tumor center and store the normalized result.
+    the cache lives in {root}/roi_cache/{type}_{key}, a change of args.txt,
+    the range file or the crop size yields a new key and a rebuild.
+    sharded runs fill the same cache, each shard marks its part with its own done_name.
+    returns the cache path of every sample (None where it failed) and the (path, error) of the failures"""
+    key = roi_cache_key(root, data_type, crop)
+    cache_root = os.path.join(root, 'roi_cache')
+    cache_dir = os.path.join(cache_root, '{}_{}'.format(data_type[0], key))
+    cache_paths = [os.path.join(cache_dir, os.path.basename(p)) for p in paths]
+    done_path = os.path.join(cache_dir, done_name)
+    if os.path.exists(done_path):
+        # failures of the build are in the quarantine, they are not asked for again
+        return cache_paths, []
+
+    # drop caches built with outdated settings
+    for d in glob('{}/{}_*'.format(cache_root, data_type[0])):
+        if d != cache_dir:
+            shutil.rmtree(d, ignore_errors=True)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    print('%s: build roi cache %s (%d samples)' % (datetime.now(), cache_dir, len(paths)))
+    jobs = [(src, dst, data_type, x_range, y_range, crop) for src, dst in zip(paths, cache_paths)]
+    pool = multiprocessing.Pool(max(num_worker, 1))
+    try:
+        errors = pool.map(_cache_sample, jobs, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    failed = [(src, err) for src, err in zip(paths, errors) if err is not None]
+    cache_paths = [None if err is not None else dst for dst, err in zip(cache_paths, errors)]
+
+    with open(done_path, 'w') as f:
+        json.dump({'crop': list(crop), 'data_type': data_type,
+                   'num_samples': len(paths), 'num_failed': len(failed)}, f)
+    print('%s: roi cache done, %d samples failed' % (datetime.now(), len(failed)))
+    return cache_paths, failed
+
+def benchmark_augment(config, num_batches=50):
+    # batches/s of the input pipeline with and without in-graph augmentation,
+    # and the augmentation alone on a batch that stays in memory
+    batch_manager = BatchManager(config)
+    if batch_manager.loader == 'dataset':
+        x, y, geom = batch_manager.it.get_next()
+    else:
+        x, y, geom = batch_manager.q.dequeue_many(batch_manager.batch_size)
+    x_aug, geom_aug = batch_manager.augment(x, geom)
+    x_var = tf.Variable(x, trainable=False)
+    geom_var = tf.Variable(geom, trainable=False)
+    x_mem, geom_mem = batch_manager.augment(x_var, geom_var)
+
+    sess = tf.Session()
+    batch_manager.start_thread(sess)
+    sess.run([x_var.initializer, geom_var.initializer])
+    for name, fetch in [('plain', [x, y, geom]), ('augmented', [x_aug, y, geom_aug]),
+                        ('augment only', [x_mem, geom_mem])]:
+        start = time.time()
+        for _ in range(num_batches):
+            sess.run(fetch)
+        elapsed = time.time() - start
+        print('%s: %s %.1f batches/s (%.1f samples/s)' % (datetime.now(), name, num_batches/elapsed,
+                                                          num_batches*batch_manager.batch_size/elapsed))
+    batch_manager.stop_thread()
 
 def test3d(config):
     prepare_dirs_and_logger(config)
@@ -496,6 +1402,12 @@ if __name__ == "__main__":
     from util import prepare_dirs_and_logger, save_config, save_image
     config, unparsed = get_config()
 
+    # python data.py benchmark_augment --is_3d True --flip_axes zyx ...
+    if unparsed and unparsed[0] == 'benchmark_augment':
+        prepare_dirs_and_logger(config)
+        benchmark_augment(config)
+        sys.exit(0)
+
     # ##############
     # test: 2d
     setattr(config, 'dataset', 'smoke_pos21_size5_f200')
@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 
 from tqdm import trange
 from ops import *
+from stats import code_stats, open_code
 
 class BatchManager(object):
     def __init__(self, config):
@@ -28,7 +29,10 @@ class BatchManager(object):
         self.w_num = config.w_size
         self.z_num = config.z_num
         self.dof = int(self.args['num_dof'])
-        self.code_path = os.path.join(config.code_path, 'code%d.npz' % self.z_num)
+        # code%d/ (see stats.unpack_code) is mmapped, code%d.npz has to be read into memory
+        self.code_path = os.path.join(config.code_path, 'code%d' % self.z_num)
+        if not os.path.isdir(self.code_path):
+            self.code_path += '.npz'
         
         self.features_dim = [None, self.z_num+self.dof] # + x,y
         self.features_w_dim = [None, self.w_num, self.z_num+self.dof]
@@ -37,83 +41,31 @@ class BatchManager(object):
         self.labels_w_dim = [None, self.w_num, self.z_num]
         self.batch_size = config.batch_size
 
-        self.features_placeholder = tf.placeholder(tf.float32, self.features_dim)
-        self.labels_placeholder = tf.placeholder(tf.float32, self.labels_dim)
-        self.features_w_placeholder = tf.placeholder(tf.float32, self.features_w_dim)
-        self.labels_w_placeholder = tf.placeholder(tf.float32, self.labels_w_dim)
+        self.seed = config.random_seed
+        self.shuffle_buffer = config.shuffle_buffer
 
-        train_dataset = tf.data.Dataset.from_tensor_slices((self.features_placeholder, self.labels_placeholder))\
-                    .batch(self.batch_size).repeat().shuffle(buffer_size=50)
-        
-        test_dataset = tf.data.Dataset.from_tensor_slices((self.features_placeholder, self.labels_placeholder))\
-                    .batch(self.batch_size)
-
-        train_w_dataset = tf.data.Dataset.from_tensor_slices((self.features_w_placeholder, self.labels_w_placeholder))\
-                    .batch(self.batch_size).repeat().shuffle(buffer_size=50)
-        
-        test_w_dataset = tf.data.Dataset.from_tensor_slices((self.features_w_placeholder, self.labels_w_placeholder))\
-                    .batch(self.batch_size)
-        
-        self.train_iterator = train_dataset.make_initializable_iterator()
-        self.test_iterator = test_dataset.make_initializable_iterator()
-        self.train_w_iterator = train_w_dataset.make_initializable_iterator()
-        self.test_w_iterator = test_w_dataset.make_initializable_iterator()
+        # load data, rows are normalized per batch in take()
+        code = open_code(self.code_path)
+        self.x, self.y, self.p = code['x'], code['y'], code['p']
 
-        # load data
-        code = np.load(self.code_path)
-        x = code['x']
-        y = code['y']
-        p = code['p']
+        self.num_scenes = int(code['s'])
+        self.num_frames = int(code['f'])
 
-        self.num_scenes = code['s']
-        self.num_frames = code['f']
-
-        self.code_std = np.std(x)
-        y -= x
-        self.out_std = np.std(y)
-        self.p_std = np.std(p)
-
-        x /= self.code_std
-        y /= self.out_std
-        p /= self.p_std
-
-        self.x_train = np.concatenate((x,p), axis=-1)
-        self.y_train = y
+        stats = code_stats(self.code_path)
+        self.code_std = float(stats['x'].std)
+        self.out_std = float(stats['out'].std)
+        self.p_std = float(stats['p'].std)
 
         self.num_train_scenes = int(self.num_scenes * 0.95)
         self.num_test_scenes = self.num_scenes - self.num_train_scenes
         self.num_train = self.num_train_scenes * (self.num_frames-1)
-        self.num_test = self.x_train.shape[0] - self.num_train
+        self.num_test = self.x.shape[0] - self.num_train
 
-        self.x_test, self.y_test = self.x_train[self.num_train:], self.y_train[self.num_train:]
-        self.x_train, self.y_train = self.x_train[:self.num_train], self.y_train[:self.num_train]
-                
-        num_batches = self.num_train_scenes * (self.num_frames-self.w_num)
-        self.x_train_w = np.zeros(shape=[num_batches]+self.features_w_dim[1:])
-        self.y_train_w = np.zeros(shape=[num_batches]+self.labels_w_dim[1:])
-        k = 0
-        for i in range(self.num_train_scenes):
-            for j in range(self.num_frames-self.w_num):
-                idx = i*(self.num_frames-1) + j
-                # print('%d/%d: %d-%d' % (k, self.x_train_w.shape[0], idx, idx+self.w_num))
-                self.x_train_w[k,:,:] = self.x_train[idx:idx+self.w_num,:]
-                # self.y_train_w[k,:] = self.y_train[idx+self.w_num-1,:]
-                self.y_train_w[k,:,:] = self.y_train[idx:idx+self.w_num,:]
-                k += 1
-
-        num_batches = self.num_test_scenes * (self.num_frames-self.w_num)
-        self.x_test_w = np.zeros(shape=[num_batches]+self.features_w_dim[1:])
-        self.y_test_w = np.zeros(shape=[num_batches]+self.labels_w_dim[1:])
-        k = 0
-        for i in range(self.num_test_scenes):
-            for j in range(self.num_frames-self.w_num):
-                idx = i*(self.num_frames-1) + j
-                self.x_test_w[k,:,:] = self.x_test[idx:idx+self.w_num,:]
-                self.y_test_w[k,:,:] = self.y_test[idx:idx+self.w_num,:]
-                k += 1
-
-        self.num_train_w = self.x_train_w.shape[0]
-        self.num_test_w = self.x_test_w.shape[0]
+        self.train_w_idx = window_starts(self.num_train_scenes, self.num_frames, self.w_num)
+        self.test_w_idx = window_starts(self.num_test_scenes, self.num_frames, self.w_num)
+
+        self.num_train_w = self.train_w_idx.shape[0]
+        self.num_test_w = self.test_w_idx.shape[0]
         self.num_samples = self.num_train + self.num_test
         
         print('%s: # samples %d (train %d/test %d/batch size %d)' % (
@@ -126,26 +78,60 @@ class BatchManager(object):
         self.epochs_per_step = 1 / self.train_w_steps
         self.c_num = 0
 
+        # the code arrays stay in numpy, tf.data only sees sample indices
+        self.train_iterator = self.code_dataset(0, self.num_train, shuffle=True).make_initializable_iterator()
+        self.test_iterator = self.code_dataset(self.num_train, self.num_test).make_initializable_iterator()
+        self.train_w_iterator = self.code_dataset(0, self.num_train, self.train_w_idx,
+                                                  shuffle=True).make_initializable_iterator()
+        self.test_w_iterator = self.code_dataset(self.num_train, self.num_test,
+                                                 self.test_w_idx).make_initializable_iterator()
+
+    def rows(self, i):
+        # normalized features (code, params) and labels (code difference) of the rows i
+        x = np.asarray(self.x[i], dtype=np.float32)
+        p = np.asarray(self.p[i], dtype=np.float32)
+        y = np.asarray(self.y[i], dtype=np.float32)
+        return np.concatenate((x / self.code_std, p / self.p_std), axis=-1), (y - x) / self.out_std
+
+    def test_rows(self, start, num):
+        # num consecutive rows of the test split
+        return self.rows(np.arange(start, start+num) + self.num_train)
+
+    def code_dataset(self, offset, num, starts=None, shuffle=False):
+        # samples are the rows offset.. offset+num, or windows of w_num rows beginning at offset+starts
+        if starts is not None:
+            num = starts.shape[0]
+        ds = tf.data.Dataset.range(num)
+        if shuffle:
+            ds = ds.shuffle(self.shuffle_buffer, seed=self.seed).repeat()
+        ds = ds.batch(self.batch_size)
+
+        def take(i):
+            if starts is not None:
+                i = starts[i][:, None] + np.arange(self.w_num)
+            return self.rows(i + offset)
+
+        if starts is None:
+            features_dim, labels_dim = self.features_dim, self.labels_dim
+        else:
+            features_dim, labels_dim = self.features_w_dim, self.labels_w_dim
+        def set_shape(xb, yb):
+            xb.set_shape(features_dim)
+            yb.set_shape(labels_dim)
+            return xb, yb
+
+        ds = ds.map(lambda i: tuple(tf.py_func(take, [i], [tf.float32, tf.float32], stateful=False)))
+        return ds.map(set_shape).prefetch(1)
+
     def init_it(self, sess):
         print('%s: initialize train/test dataset iterator' % datetime.now())
                 
         self.sess = sess
-        self.sess.run(self.train_iterator.initializer,
-                 feed_dict={self.features_placeholder: self.x_train,
-                            self.labels_placeholder: self.y_train})
-        
-        self.sess.run(self.train_w_iterator.initializer,
-                 feed_dict={self.features_w_placeholder: self.x_train_w,
-                            self.labels_w_placeholder: self.y_train_w})
+        self.sess.run([self.train_iterator.initializer, self.train_w_iterator.initializer])
 
     def init_test_it(self):
-        self.sess.run(self.test_iterator.initializer,
-                 feed_dict={self.features_placeholder: self.x_test,
-                            self.labels_placeholder: self.y_test})
-
-        self.sess.run(self.test_w_iterator.initializer,
-                 feed_dict={self.features_w_placeholder: self.x_test_w,
-                            self.labels_w_placeholder: self.y_test_w})
+        # only rewinds the index datasets, no data is copied
+        self.sess.run([self.test_iterator.initializer, self.test_w_iterator.initializer])
 
     def batch(self, is_window=False):
         if is_window:
@@ -159,6 +145,11 @@ class BatchManager(object):
         else:
             return self.test_iterator.get_next()
 
+def window_starts(num_scenes, num_frames, w_num):
+    # first row of every window, a scene holds num_frames-1 rows and windows stay within a scene
+    j = np.arange(num_frames - w_num)
+    return (np.arange(num_scenes)[:, None]*(num_frames-1) + j).flatten().astype(np.int32)
+
 def main(config):
     prepare_dirs_and_logger(config)
     batch_manager = BatchManager(config)
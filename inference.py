@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import threading
+from glob import glob
+from datetime import datetime
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+from model import TumorGenerator, TumorEncoder, TumorDecoder
+from data import compact_geom
+from manifest import read_args
+from store import anatomy_id
+
+# surrogate inference with a latent anatomy cache
+#
+# the encoder branch of model.TumorGenerator only sees the anatomy, so a patient is encoded
+# once and every (D_w, rho, t) query only runs expand_params_fc + GeneratorBE3. latents are
+# kept per anatomy hash (store.anatomy_id) with LRU eviction. callers that query one
+# anatomy many times pass its key, so that it is hashed only once.
+
+class TumorSurrogate(object):
+    def __init__(self, config, y_range, x_range=1., ckpt_path=None, cache_size=None):
+        """y_range [[min, max]] and x_range as in data.BatchManager, ckpt_path defaults to the latest in load_path"""
+        self.data_type = config.data_type
+        self.arch = config.arch
+        self.x_range = x_range
+        self.y_range = np.array(y_range, dtype=np.float64)
+        self.batch_size = config.test_batch_size
+        self.crop = [config.res_z, config.res_y, config.res_x]
+        self.geom_format = config.geom_format
+
+        self.capacity = cache_size or config.latent_cache
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        args = (config.filters, config.num_conv, config.repeat, config.arch)
+        output_shape = self.crop + [1]
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            # the encoder reshapes with a static batch size, anatomies go in one at a time.
+            # the geometry is fed in the training geom_format, see data.compact_geom
+            geom_dtype = tf.float32 if self.geom_format == 'float' else tf.uint8
+            self.geom = tf.placeholder(geom_dtype, shape=[1] + self.crop + [1 if self.geom_format == 'label' else 3])
+            self.y = tf.placeholder(tf.float32, shape=[None, len(y_range)])
+            with tf.variable_scope('tumor', reuse=tf.AUTO_REUSE):
+                self.zz = TumorEncoder(self.geom, *args)
+                self.zz_in = tf.placeholder(tf.float32, shape=self.zz.get_shape())
+                zz = tf.tile(self.zz_in, [tf.shape(self.y)[0]] + [1]*(len(self.zz.get_shape())-1))
+                self.G = TumorDecoder(zz, self.y, config.filters, output_shape, *args[1:])
+            # full generator, encoder and decoder per query
+            self.y_one = tf.placeholder(tf.float32, shape=[1, len(y_range)])
+            self.G_full, variables = TumorGenerator(self.geom, self.y_one, config.filters, output_shape,
+                                                    config.num_conv, config.repeat, config.arch,
+                                                    name='tumor', reuse=tf.AUTO_REUSE)
+
+            ckpt_path = ckpt_path or tf.train.latest_checkpoint(config.load_path)
+            if ckpt_path is None:
+                raise Exception("[!] No checkpoint in %s" % config.load_path)
+            gpu_options = tf.GPUOptions(allow_growth=True)
+            self.sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True, gpu_options=gpu_options))
+            tf.train.Saver(variables).restore(self.sess, ckpt_path)
+        print('%s: restored %s' % (datetime.now(), ckpt_path))
+
+    def normalize(self, p):
+        # physical parameters [N, num_param] to the [-1, 1] inputs of the generator (see data.normalize)
+        p = np.atleast_2d(np.asarray(p, dtype=np.float64))
+        return ((p - self.y_range[:,0]) / (self.y_range[:,1] - self.y_range[:,0]) * 2 - 1).astype(np.float32)
+
+    def denormalize(self, G):
+        if self.data_type[0] == 'd':
+            return (G + 1) * 0.5
+        return G * self.x_range
+
+    def feed_geom(self, anatomy):
+        # [z, y, x, 3] tissue probabilities as the generator was trained on them
+        return compact_geom(np.asarray(anatomy, dtype=np.float32), self.geom_format)[None]
+
+    def key(self, anatomy):
+        return anatomy_id(np.asarray(anatomy, dtype=np.float32))
+
+    def latent(self, anatomy, key=None):
+        """latent anatomy of a [z, y, x, 3] crop of tissue probabilities, encoded on the first query only.
+        key is self.key(anatomy), computed here if not given"""
+        if key is None:
+            key = self.key(anatomy)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+
+        zz = self.sess.run(self.zz, {self.geom: self.feed_geom(anatomy)})
+        with self.lock:
+            self.cache[key] = zz
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        return zz
+
+    def predict(self, anatomy, p, key=None):
+        """concentration [N, z, y, x] for the physical parameters p [N, num_param] in one anatomy"""
+        zz = self.latent(anatomy, key)
+        y = self.normalize(p)
+        out = []
+        for i in range(0, y.shape[0], self.batch_size):
+            out.append(self.sess.run(self.G, {self.zz_in: zz, self.y: y[i:i+self.batch_size]}))
+        return self.denormalize(np.concatenate(out, axis=0)[..., 0])
+
+    def predict_full(self, anatomy, p):
+        # without the cache, encoder and decoder for every query
+        geom = self.feed_geom(anatomy)
+        out = [self.sess.run(self.G_full, {self.geom: geom, self.y_one: yi[None]}) for yi in self.normalize(p)]
+        return self.denormalize(np.concatenate(out, axis=0)[..., 0])
+
+    def benchmark(self, anatomy, num_queries=100, seed=123, solver_timing=None):
+        """ms per query of the full generator, the cached decoder one query at a time and batched"""
+        rng = np.random.RandomState(seed)
+        p = rng.uniform(self.y_range[:,0], self.y_range[:,1], size=(num_queries, len(self.y_range)))
+
+        # warm up both paths, the first latent() is the one cache miss
+        self.predict_full(anatomy, p[:1])
+        start = time.time()
+        key = self.key(anatomy)
+        hashing = time.time() - start
+        self.latent(anatomy, key)
+        encode = time.time() - start - hashing
+        self.predict(anatomy, p[:1], key)
+
+        timing = {'hash_ms': 1000*hashing, 'encode_ms': 1000*encode}
+        start = time.time()
+        self.predict_full(anatomy, p)
+        timing['full_ms'] = 1000*(time.time() - start) / num_queries
+        start = time.time()
+        for pi in p:
+            self.predict(anatomy, pi[None], key)
+        timing['cached_ms'] = 1000*(time.time() - start) / num_queries
+        start = time.time()
+        self.predict(anatomy, p, key)
+        timing['cached_batch_ms'] = 1000*(time.time() - start) / num_queries
+        timing['speedup'] = timing['full_ms'] / timing['cached_ms']
+
+        print('%s: hash %.1f ms, encode %.1f ms, per query: full %.1f ms, cached %.1f ms (%.1fx), cached in batches of %d %.1f ms' % (
+            datetime.now(), timing['hash_ms'], timing['encode_ms'], timing['full_ms'], timing['cached_ms'], timing['speedup'],
+            self.batch_size, timing['cached_batch_ms']))
+        if solver_timing is not None and os.path.exists(solver_timing):
+            with open(solver_timing, 'r') as f:
+                seconds = json.load(f)['seconds_per_sample']
+            timing['solver_ms'] = 1000*seconds
+            print('%s: solver %.1f ms per sample, %.0fx the cached query' % (
+                datetime.now(), timing['solver_ms'], timing['solver_ms'] / timing['cached_ms']))
+        return timing
+
+def dataset_ranges(root, data_type):
+    # y_range and x_range of a dataset, as computed by data.BatchManager
+    args = read_args(root)
+    y_range = []
+    for i in range(int(args['num_param'])):
+        p_name = args['p%d' % i]
+        y_range.append([float(args['min_{}'.format(p_name)]), float(args['max_{}'.format(p_name)])])
+    r = np.loadtxt(os.path.join(root, data_type[0]+'_range.txt'))
+    return y_range, max(abs(r[0]), abs(r[1]))
+
+if __name__ == "__main__":
+    from config import get_config
+    from data import preprocess
+    config, unparsed = get_config()
+
+    # python inference.py --load_path log/... --dataset ... --data_type density --arch ...
+    root = os.path.join(config.data_dir, config.dataset)
+    y_range, x_range = dataset_ranges(root, config.data_type)
+    surrogate = TumorSurrogate(config, y_range, x_range)
+
+    path = sorted(glob("{}/{}/*.npz".format(root, config.data_type[0])))[0]
+    _, _, anatomy = preprocess(path, config.data_type, x_range, y_range,
+                               (config.res_z, config.res_y, config.res_x))
+    timing = surrogate.benchmark(anatomy, solver_timing=os.path.join(root, 'solver_timing.json'))
+    with open(os.path.join(config.load_path, 'inference_timing.json'), 'w') as f:
+        json.dump(timing, f, indent=2)
@@ -16,6 +16,8 @@ def main(config):
 
     if 'nn' in config.arch:
         from data_nn import BatchManager
+    elif config.dataset == 'synthetic':
+        from data import SyntheticBatchManager as BatchManager
     else:
         from data import BatchManager
     batch_manager = BatchManager(config)
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import multiprocessing
+from glob import glob
+from datetime import datetime
+
+import numpy as np
+
+# dataset manifest, {root}/{type}_manifest.jsonl
+#
+# first line: {"args": {...args.txt...}, "args_sha1": ..., "data_type": ..., "seed": ..., "num_samples": ..., "num_train": ...}
+# then one line per sample:
+#             {"path": "{type}/name.npz", "p": [...raw params...], "center": [y3, y4, y5], "split": "train"|"val"}
+#
+# built once per dataset, so the loaders neither glob nor parse args.txt at startup,
+# and the train/validation split is the same for every run. a manifest whose args.txt hash or
+# sample count no longer match the dataset on disk is stale, see is_current.
+
+def manifest_path(root, data_type):
+    return os.path.join(root, data_type[0] + '_manifest.jsonl')
+
+def read_args(root):
+    args = {}
+    with open(os.path.join(root, 'args.txt'), 'r') as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            arg, arg_value = line[:-1].split(': ')
+            args[arg] = arg_value
+    return args
+
+def args_hash(root):
+    with open(os.path.join(root, 'args.txt'), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def is_current(root, data_type, header):
+    # the dataset was not regenerated since the manifest was built
+    return header.get('args_sha1') == args_hash(root) and \
+        len(glob("{}/{}/*".format(root, data_type[0]))) == header['num_samples']
+
+def _read_label(path):
+    # only y is decompressed, the volume is left untouched
+    with np.load(path) as data:
+        return data['y'].tolist()
+
+def build_manifest(root, data_type, seed, arch='', val_ratio=0.1, num_worker=1):
+    args = read_args(root)
+    paths = glob("{}/{}/*".format(root, data_type[0]))
+    if 'ae' in arch:
+        def sortf(x):
+            nf = int(args['num_frames'])
+            n = os.path.basename(x)[:-4].split('_')
+            return int(n[0])*nf + int(n[1])
+        paths = sorted(paths, key=sortf)
+    else:
+        paths = sorted(paths)
+    assert(len(paths) > 0)
+
+    print('%s: build manifest for %d samples' % (datetime.now(), len(paths)))
+    pool = multiprocessing.Pool(max(num_worker, 1))
+    try:
+        labels = pool.map(_read_label, paths, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+
+    num_train = int((1-val_ratio) * len(paths))
+    is_train = np.zeros(len(paths), dtype=bool)
+    is_train[np.random.RandomState(seed).permutation(len(paths))[:num_train]] = True
+
+    num_param = int(args['num_param'])
+    out_path = manifest_path(root, data_type)
+    with open(out_path + '.tmp', 'w') as f:
+        f.write(json.dumps({'args': args, 'args_sha1': args_hash(root), 'data_type': data_type, 'seed': seed,
+                            'num_samples': len(paths), 'num_train': num_train}) + '\n')
+        for path, y, t in zip(paths, labels, is_train):
+            f.write(json.dumps({'path': os.path.relpath(path, root),
+                                'p': y[:num_param],
+                                'center': y[3:6],
+                                'split': 'train' if t else 'val'}) + '\n')
+    os.rename(out_path + '.tmp', out_path)
+    print('%s: manifest written to %s' % (datetime.now(), out_path))
+    return out_path
+
+def read_manifest(path):
+    with open(path, 'r') as f:
+        header = json.loads(f.readline())
+        samples = [json.loads(line) for line in f]
+    assert(len(samples) == header['num_samples'])
+    return header, samples
+
+if __name__ == "__main__":
+    from config import get_config
+    config, unparsed = get_config()
+    root = os.path.join(config.data_dir, config.dataset)
+    build_manifest(root, config.data_type, config.random_seed, config.arch,
+                   num_worker=config.num_worker)
@@ -41,56 +41,82 @@ def laplacian3D(u):
 
     return tf.squeeze(out)
 
+def decode_geom(geom):
+    """expand the compact geometry of the input pipeline (see data.compact_geom) to float tissue probabilities"""
+    if geom.dtype == tf.float32:
+        return geom
+    if get_conv_shape(geom)[-1] == 1:
+        # label map, drop the background channel of the one-hot encoding
+        return tf.one_hot(tf.squeeze(tf.cast(geom, tf.int32), -1), 4)[..., 1:]
+    return tf.cast(geom, tf.float32) / 255.
+
 def construct_diffusivity(brain_anatomy , D_w):
     """this function calculates the parameter D of the tumor growth PDE, required to calculate the loss derived from physics
     formula: D =  D_w*p_w + D_g*p_g 
     D_w = 10 * D_g """
+    brain_anatomy = decode_geom(brain_anatomy)
     D_w = tf.reshape(D_w,get_conv_shape(D_w)+[1,1,1])
     assert len(get_conv_shape(brain_anatomy)) is 5, 'problemo'
     diffu = tf.math.add (tf.math.multiply(D_w, brain_anatomy[:,:,:,:,1]) , tf.math.multiply(D_w*0.1,brain_anatomy[:,:,:,:,2]) )
 
     return diffu
 
-def du_dt(concentration_output, parameters_input ): #TODO:debug this function
-    """super inefficient function, however I can't think of any way to do it with available tf.gradients in tf.
-    See discussion: https://github.com/tensorflow/tensorflow/issues/4897
-    what makes this discussion DOUBLE inefficient is that on top of the 4 for loops
-    we are calculating the gradient not only wrt to time, but wrt to all input parameters.
-    This is because slicing the 'parameters_input' tensor to extract only the time would 
-    modify the computational graph, and the time slice would not be connected in the graph with 
-    the concentration_output """
-
-    
-    b,w,l,h,_ = get_conv_shape(concentration_output)
-    print('we are here')
-    for i in range(b):
-        b_list = []
-        for j in range(w):
-            l_list = []
-            for m in range(l):
-                h_list = []
-                for n in range(h):
-                    h_list.append(tf.gradients(concentration_output[i,j,m,n],parameters_input)[0][i,2]) #[0] as tf.gradients returns list, [m,2] as we are interested in time(position 2 in input) of batch i
-                
-                l_list.append(tf.stack(h_list))
-
-            w_list.append(tf.stack(l_list))
-        
-        b_list.append(tf.stack(h_list))
-    
-    out = tf.stack(b_list)  
-
-    #old alternative (did not debug as the operation takes too long):
-    #out = tf.stack([tf.stack([tf.stack([tf.stack([tf.gradients(concentration_output[m,i,j,k],parameters_input)[0][m,2] for k in range(h)]) for j in range (l)]) for i in range(w)]) for m in range(b)])
-    print('debug in du_dt, shape of out is :' , get_conv_shape(out))
-    
-    return out  
-
-
-
-
-
+def physics_residual(u, anatomy, D_w, rho, spacing):
+    """div(D grad u) + rho u (1 - u) with D = D_w p_w + 0.1 D_w p_g, in flux form: a face carries the mean D
+    of its two cells, nothing flows through the border or into cells without tissue (numpy twin: solver.residual).
+    u [B,z,y,x,1] and anatomy [B,z,y,x,C] in physical units, D_w and rho [B], spacing in the length unit of D"""
+    anatomy = decode_geom(anatomy)
+    D = tf.reshape(D_w, [-1,1,1,1,1]) * (anatomy[...,1:2] + 0.1*anatomy[...,2:3])
+    div = 0.
+    for axis in [1,2,3]:
+        lo = [slice(None)]*5
+        hi = [slice(None)]*5
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        D_lo, D_hi = D[tuple(lo)], D[tuple(hi)]
+        D_face = tf.where(tf.logical_and(D_lo > 0, D_hi > 0), 0.5*(D_lo + D_hi), tf.zeros_like(D_lo))
+        flux = D_face * (u[tuple(hi)] - u[tuple(lo)])
+        # a face adds its flux to the cell below and takes it from the cell above
+        pad_lo = [[0,0]]*5
+        pad_hi = [[0,0]]*5
+        pad_lo[axis] = [0,1]
+        pad_hi[axis] = [1,0]
+        div += tf.pad(flux, pad_lo) - tf.pad(flux, pad_hi)
+    return div / spacing**2 + tf.reshape(rho, [-1,1,1,1,1]) * u * (1 - u)
+
+def benchmark_residual(batch_size=4, res=64, num_runs=20):
+    """time and bytes allocated per evaluation, physics_residual vs. laplacian3D + construct_diffusivity"""
+    import time
+    u = tf.random_uniform([batch_size, res, res, res, 1])
+    anatomy = tf.random_uniform([batch_size, res, res, res, 3])
+    D_w = tf.random_uniform([batch_size], 0.0002, 0.015)
+    rho = tf.random_uniform([batch_size], 0.002, 0.2)
+    old = tf.expand_dims(construct_diffusivity(anatomy, D_w)*laplacian3D(u), -1) + \
+          tf.reshape(rho, [-1,1,1,1,1]) * u * (1 - u)
+    new = physics_residual(u, anatomy, D_w, rho, 1.) # unit spacing, as laplacian3D
 
+    with tf.Session() as sess:
+        for name, r in [('laplacian3D + construct_diffusivity', old), ('physics_residual', new)]:
+            sess.run(r)
+            meta = tf.RunMetadata()
+            sess.run(r, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=meta)
+            nbytes = sum(o.tensor_description.allocation_description.requested_bytes
+                         for d in meta.step_stats.dev_stats for n in d.node_stats for o in n.output)
+            start = time.time()
+            for _ in range(num_runs):
+                sess.run(r)
+            print('%s: %.1f ms, %.1f MB allocated' % (name, 1000*(time.time()-start)/num_runs, nbytes/2.**20))
+
+def du_dt(concentration_output, parameters_input, time_index=2):
+    """derivative of the whole output volume w.r.t. the time input (position time_index of parameters_input),
+    as one forward-mode product J*e_t built from two reverse passes (double tf.gradients):
+    g(v) = J^T v is linear in the dummy v, so the gradient of <g(v), e_t> w.r.t. v is J e_t.
+    the derivative is w.r.t. the input as fed, i.e. the normalized time"""
+    v = tf.zeros_like(concentration_output) # value irrelevant, only the graph of J^T v is used
+    g = tf.gradients(concentration_output, parameters_input, grad_ys=v)[0]
+    e_t = tf.one_hot(tf.fill(tf.shape(parameters_input)[:1], time_index), tf.shape(parameters_input)[1])
+    out = tf.gradients(g, v, grad_ys=e_t)[0]
+    return out
 
 def lrelu(x, leak=0.2):
     return tf.maximum(x, leak*x)
@@ -163,18 +189,12 @@ def upscale(x, scale, data_format='NHWC'):
     return resize_nearest_neighbor(x, (h*scale, w*scale), data_format)
 
 def upscale3(x, scale):
+    # nearest neighbour by reshape + tile, same output as resize_nearest_neighbor at an integer scale,
+    # but its gradient is differentiable again (ResizeNearestNeighborGrad has no gradient), see du_dt
     b, d, h, w, c = int_shape(x)
-
-    hw = tf.reshape(tf.transpose(x, [0,2,3,1,4]), [b,h,w,d*c])
-    h *= scale
-    w *= scale
-    hw = tf.image.resize_nearest_neighbor(hw, (h,w))
-    hw = tf.reshape(hw, [b,h,w,d,c])
-
-    dh = tf.reshape(tf.transpose(hw, [0,3,1,2,4]), [b,d,h,w*c])
-    d *= scale    
-    dh = tf.image.resize_nearest_neighbor(dh, (d,h))
-    return tf.reshape(dh, [b,d,h,w,c])
+    x = tf.reshape(x, [b, d, 1, h, 1, w, 1, c])
+    x = tf.tile(x, [1, 1, scale, 1, scale, 1, scale, 1])
+    return tf.reshape(x, [b, d*scale, h*scale, w*scale, c])
 
 def var_on_cpu(name, shape, initializer, dtype=tf.float32):
     return slim.model_variable(name, shape, dtype=dtype, initializer=initializer, device='/CPU:0')
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+# reference Fisher-KPP solver
+#
+#   du/dt = div(D grad u) + rho u (1 - u),   D = D_w p_w + 0.1 D_w p_g   (see ops.physics_residual)
+#
+# explicit euler in flux form on a regular grid. face diffusivities are averages of the
+# neighbouring cells, the flux through the domain boundary and into cells without
+# tissue is zero. a sweep simulates every (D_w, rho) pair once and writes a sample at
+# every time of the t grid, in the layout read by data.preprocess:
+#
+# {root}/args.txt             num_param, p0.., min_/max_/num_{p}, path_format
+# {root}/{type}/i_j_k.npz     x [res, res, res, 4] concentration + tissue (csf, wm, gm),
+#                             y [D_w, rho, t, cz, cy, cx], center in [0, 1] of the grid
+# {root}/{type}_range.txt     min/max of the concentration
+# {root}/solver_timing.json   seconds per simulation, for the surrogate speedup
+
+PARAMS = ['D_w', 'rho', 't']
+
+def diffusivity(anatomy, D_w):
+    # anatomy [..., 3] = csf, wm, gm probabilities
+    return D_w * anatomy[..., 1] + 0.1 * D_w * anatomy[..., 2]
+
+def face_diffusivity(D):
+    # mean of the two cells next to each face, per axis; faces into cells without tissue carry no flux
+    faces = []
+    for a in range(3):
+        lo = [slice(None)]*3
+        hi = [slice(None)]*3
+        lo[a] = slice(None, -1)
+        hi[a] = slice(1, None)
+        Dl, Dh = D[tuple(lo)], D[tuple(hi)]
+        faces.append(np.where((Dl > 0) & (Dh > 0), 0.5 * (Dl + Dh), 0))
+    return faces
+
+def flux_divergence(u, D_faces, h):
+    # div(D grad u) of the flux form
+    div = np.zeros_like(u)
+    for a, Df in enumerate(D_faces):
+        flux = Df * np.diff(u, axis=a)
+        lo = [slice(None)]*3
+        hi = [slice(None)]*3
+        lo[a] = slice(None, -1)
+        hi[a] = slice(1, None)
+        div[tuple(lo)] += flux
+        div[tuple(hi)] -= flux
+    return div / h**2
+
+def residual(u, anatomy, D_w, rho, spacing):
+    """div(D grad u) + rho u (1 - u) of one volume u [z, y, x], numpy twin of ops.physics_residual.
+    compare with the time derivative of generated volumes to evaluate them offline"""
+    return flux_divergence(u, face_diffusivity(diffusivity(anatomy, D_w)), spacing) + rho * u * (1 - u)
+
+def step(u, D_faces, rho, dt, h):
+    # one explicit euler step
+    return u + dt * (flux_divergence(u, D_faces, h) + rho * u * (1 - u))
+
+def solve(anatomy, D_w, rho, times, center, spacing=0.1, sigma=1.0):
+    """concentration at every time in times (ascending), for a tumor seeded at the voxel center"""
+    D = diffusivity(anatomy, D_w)
+    D_faces = face_diffusivity(D)
+    tissue = D > 0
+
+    grid = np.meshgrid(*[np.arange(n) for n in D.shape], indexing='ij')
+    r2 = sum((g - c)**2 for g, c in zip(grid, center))
+    u = np.where(tissue, np.exp(-r2 / (2 * sigma**2)), 0)
+
+    # stability of the explicit scheme: diffusion (6 neighbours) and reaction
+    dt_max = 0.9 * min(spacing**2 / (6 * max(D.max(), 1e-12)), 0.5 / max(rho, 1e-12))
+    t, out = 0., []
+    for t_next in times:
+        num_steps = int(np.ceil((t_next - t) / dt_max))
+        dt = (t_next - t) / max(num_steps, 1)
+        for _ in range(num_steps):
+            u = step(u, D_faces, rho, dt, spacing)
+        t = t_next
+        out.append(u.astype(np.float32))
+    return out
+
+def synthetic_anatomy(res, seed=0):
+    """a smooth random brain: wm core, gm shell, csf ventricles, as [res, res, res, 3] probabilities"""
+    from scipy import ndimage
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, res)]*3, indexing='ij')
+    r = np.sqrt(sum((g / s)**2 for g, s in zip(grid, [0.8, 0.9, 0.75])))
+    r = r + ndimage.gaussian_filter(rng.randn(res, res, res), res / 16.) * 2
+    brain = ndimage.gaussian_filter((r < 1).astype(np.float64), 1.)
+    wm = ndimage.gaussian_filter((r < 0.75).astype(np.float64), 1.)
+    csf = ndimage.gaussian_filter(((np.abs(grid[1]) < 0.15) & (np.abs(grid[0]) < 0.3) &
+                                   (np.abs(grid[2]) < 0.4)).astype(np.float64), 1.)
+    wm = wm * (1 - csf)
+    gm = np.clip(brain - wm - csf, 0, 1)
+    return np.stack([csf * brain, wm, gm], axis=-1).astype(np.float32)
+
+def tumor_center(anatomy, seed, margin):
+    # random voxel of mostly white matter, at least margin voxels away from the border
+    rng = np.random.RandomState(seed)
+    inner = tuple(slice(margin, n - margin) for n in anatomy.shape[:3])
+    candidates = np.argwhere(anatomy[inner][..., 1] > 0.5) + margin
+    return candidates[rng.randint(len(candidates))]
+
+def _simulate(job):
+    anatomy_path, out_dir, (i, D_w), (j, rho), times, spacing, seed, margin = job
+    anatomy = np.load(anatomy_path, mmap_mode='r')
+    center = tumor_center(anatomy, [seed, i, j], margin)
+    start = time.time()
+    us = solve(np.asarray(anatomy), D_w, rho, times, center, spacing)
+    elapsed = time.time() - start
+
+    res = anatomy.shape[0]
+    u_min, u_max = np.inf, -np.inf
+    for k, (t, u) in enumerate(zip(times, us)):
+        x = np.concatenate((u[..., None], anatomy), axis=-1)
+        y = np.array([D_w, rho, t] + list(center / float(res)))
+        np.savez_compressed(os.path.join(out_dir, '%d_%d_%d.npz' % (i, j, k)), x=x, y=y)
+        u_min, u_max = min(u_min, u.min()), max(u_max, u.max())
+    return elapsed, u_min, u_max
+
+def parse_range(s):
+    lo, hi, num = s.split(',')
+    return float(lo), float(hi), int(num)
+
+def generate_dataset(root, data_type, ranges, res=128, spacing=0.1, anatomy=None,
+                     margin=32, seed=0, num_worker=1):
+    """sweep the (D_w, rho, t) grid given by ranges {p: (min, max, num)}"""
+    out_dir = os.path.join(root, data_type[0])
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    anatomy_path = os.path.join(root, 'anatomy.npy')
+    if anatomy is None:
+        anatomy = synthetic_anatomy(res, seed)
+    assert(anatomy.shape == (res, res, res, 3)), 'anatomy must be [res, res, res, 3] (csf, wm, gm)'
+    if 2*margin >= res:
+        raise Exception("[!] no tumor center is %d voxels away from the border of a %d^3 grid" % (margin, res))
+    np.save(anatomy_path, anatomy.astype(np.float32))
+
+    values = {p: np.linspace(*ranges[p]) for p in PARAMS}
+    jobs = [(anatomy_path, out_dir, (i, D_w), (j, rho), values['t'], spacing, seed, margin)
+            for i, D_w in enumerate(values['D_w']) for j, rho in enumerate(values['rho'])]
+    print('%s: %d simulations, %d samples with %d workers' % (
+        datetime.now(), len(jobs), len(jobs) * len(values['t']), num_worker))
+
+    pool = multiprocessing.Pool(max(num_worker, 1))
+    try:
+        results = pool.map(_simulate, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    seconds = [r[0] for r in results]
+
+    with open(os.path.join(root, 'args.txt'), 'w') as f:
+        f.write('num_param: %d\n' % len(PARAMS))
+        for i, p in enumerate(PARAMS):
+            f.write('p%d: %s\n' % (i, p))
+        for p in PARAMS:
+            f.write('min_%s: %g\nmax_%s: %g\nnum_%s: %d\n' % (p, ranges[p][0], p, ranges[p][1], p, ranges[p][2]))
+        f.write('path_format: %d_%d_%d.npz\n')
+        f.write('res: %d\nspacing: %g\nseed: %d\n' % (res, spacing, seed))
+    np.savetxt(os.path.join(root, data_type[0] + '_range.txt'),
+               [min(r[1] for r in results), max(r[2] for r in results)])
+    with open(os.path.join(root, 'solver_timing.json'), 'w') as f:
+        json.dump({'res': res, 'num_times': len(values['t']), 't_max': float(values['t'][-1]),
+                   'seconds_per_simulation': float(np.mean(seconds)),
+                   'seconds_per_sample': float(np.sum(seconds)) / (len(jobs) * len(values['t'])),
+                   'seconds': seconds}, f)
+    print('%s: done, %.1f s per simulation' % (datetime.now(), np.mean(seconds)))
+
+if __name__ == "__main__":
+    from config import get_config
+    config, unparsed = get_config()
+
+    # python solver.py --dataset tumor_test --data_type density --num_worker 8
+    root = os.path.join(config.data_dir, config.dataset)
+    ranges = {'D_w': parse_range(config.sim_D_w), 'rho': parse_range(config.sim_rho),
+              't': parse_range(config.sim_t)}
+    anatomy = np.load(config.sim_anatomy) if config.sim_anatomy else None
+    generate_dataset(root, config.data_type, ranges, config.sim_res, config.sim_spacing, anatomy,
+                     margin=max(config.res_x, config.res_y, config.res_z) // 2,
+                     seed=config.random_seed, num_worker=config.num_worker)
@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from glob import glob
+from datetime import datetime
+
+import numpy as np
+
+from manifest import read_args
+from store import crop_slices
+
+class RunningStats(object):
+    """count/mean/std/min/max over axis 0, accumulated chunk by chunk (Welford/Chan merge)"""
+    def __init__(self, shape=()):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def update(self, a):
+        # a is [n] + shape, only one chunk is ever held in float64
+        a = np.asarray(a, dtype=np.float64)
+        n = a.shape[0]
+        if n == 0:
+            return self
+        mean = a.mean(axis=0)
+        m2 = ((a - mean)**2).sum(axis=0)
+        self._merge(n, mean, m2, a.min(axis=0), a.max(axis=0))
+        return self
+
+    def merge(self, other):
+        if other.n > 0:
+            self._merge(other.n, other.mean, other.m2, other.min, other.max)
+        return self
+
+    def _merge(self, n, mean, m2, amin, amax):
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta**2 * self.n * n / total
+        self.n = total
+        self.min = np.minimum(self.min, amin)
+        self.max = np.maximum(self.max, amax)
+
+    @property
+    def std(self):
+        # population std, same as np.std
+        return np.sqrt(self.m2 / max(self.n, 1))
+
+    def to_dict(self):
+        return {'n': self.n, 'mean': np.asarray(self.mean).tolist(), 'std': np.asarray(self.std).tolist(),
+                'm2': np.asarray(self.m2).tolist(),
+                'min': np.asarray(self.min).tolist(), 'max': np.asarray(self.max).tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        s = cls()
+        s.n = d['n']
+        for k in ['mean', 'm2', 'min', 'max']:
+            setattr(s, k, np.asarray(d[k], dtype=np.float64))
+        return s
+
+# latent code statistics
+#
+# code files are either code%d.npz or directories code%d/ of x.npy/y.npy/p.npy (mmapped)
+# and s.npy/f.npy (number of scenes and frames), see unpack_code. a list of files is
+# treated as shards of one dataset. the result is written to code%d_stats.json (code%d/stats.json)
+# and reused as long as the code files are unchanged.
+
+def open_code(path):
+    if os.path.isdir(path):
+        code = {k: np.load(os.path.join(path, k+'.npy'), mmap_mode='r') for k in ['x', 'y', 'p']}
+        for k in ['s', 'f']:
+            if os.path.exists(os.path.join(path, k+'.npy')):
+                code[k] = np.load(os.path.join(path, k+'.npy'))
+        return code
+    return np.load(path)
+
+def unpack_code(code_path):
+    """write code%d.npz as the directory code%d/, one array in memory at a time"""
+    out_dir = os.path.splitext(code_path)[0]
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with np.load(code_path) as code:
+        for k in ['x', 'y', 'p', 's', 'f']:
+            np.save(os.path.join(out_dir, k+'.npy'), code[k])
+    print('%s: %s unpacked to %s' % (datetime.now(), code_path, out_dir))
+    return out_dir
+
+def _signature(paths):
+    files = []
+    for p in paths:
+        files += [os.path.join(p, k+'.npy') for k in ['x', 'y', 'p']] if os.path.isdir(p) else [p]
+    return [[os.path.relpath(f, os.path.dirname(paths[0].rstrip('/'))), os.path.getsize(f), os.path.getmtime(f)]
+            for f in files]
+
+def stats_path(code_path):
+    if os.path.isdir(code_path):
+        return os.path.join(code_path, 'stats.json')
+    return os.path.splitext(code_path)[0] + '_stats.json'
+
+def code_stats(code_paths, chunk=65536):
+    """code_std, out_std and p_std of data_nn in one streaming pass, out = y - x"""
+    if not isinstance(code_paths, (list, tuple)):
+        code_paths = [code_paths]
+    out_path = stats_path(code_paths[0])
+    signature = _signature(code_paths)
+    if os.path.exists(out_path):
+        with open(out_path, 'r') as f:
+            saved = json.load(f)
+        if saved['files'] == signature:
+            return {k: RunningStats.from_dict(v) for k, v in saved['stats'].items()}
+
+    print('%s: compute code statistics of %s' % (datetime.now(), ', '.join(code_paths)))
+    stats = {'x': RunningStats(), 'out': RunningStats(), 'p': RunningStats()}
+    for path in code_paths:
+        code = open_code(path)
+        x, y, p = code['x'], code['y'], code['p']
+        for i in range(0, x.shape[0], chunk):
+            xi = x[i:i+chunk]
+            stats['x'].update(xi.reshape(-1))
+            stats['out'].update((y[i:i+chunk] - xi).reshape(-1))
+            stats['p'].update(p[i:i+chunk].reshape(-1))
+
+    with open(out_path + '.tmp', 'w') as f:
+        json.dump({'files': signature, 'stats': {k: v.to_dict() for k, v in stats.items()}}, f)
+    os.rename(out_path + '.tmp', out_path)
+    return stats
+
+# dataset statistics
+#
+# one parallel pass over {root}/{type}/*.npz, writes
+# {root}/{type}_range.txt   min/max of the first x channel, read by data.BatchManager
+# {root}/{type}_stats.json  per-channel min/max/mean/std and histograms, label and
+#                           tumor center bounds and the crop windows they imply
+
+def _sample_stats(job):
+    paths, bins, hist_range, crop = job
+    channels, hist, labels, windows = None, None, RunningStats(), RunningStats(shape=(2, 3))
+    for path in paths:
+        with np.load(path) as data:
+            x, y = data['x'], data['y']
+        res = x.shape[0]
+        x = x.reshape(-1, x.shape[-1])
+        if channels is None:
+            channels = RunningStats(shape=x.shape[-1:])
+            hist = np.zeros([x.shape[-1], bins + 2], dtype=np.int64) # + below/above the range
+        for i in range(0, x.shape[0], 2**20): # bounds the float64 temporaries
+            channels.update(x[i:i+2**20])
+        for c in range(x.shape[-1]):
+            hist[c, 1:-1] += np.histogram(x[:, c], bins=bins, range=hist_range)[0]
+            hist[c, 0] += np.count_nonzero(x[:, c] < hist_range[0])
+            hist[c, -1] += np.count_nonzero(x[:, c] > hist_range[1])
+        labels.update(np.asarray(y, dtype=np.float64)[None])
+        s = crop_slices(y, crop, res)
+        windows.update(np.array([[si.start for si in s], [si.stop for si in s]])[None])
+    return channels, hist, labels, windows
+
+def dataset_stats(root, data_type, crop, num_worker=1, bins=64, hist_range=(0, 1), chunk=16):
+    paths = sorted(glob("{}/{}/*.npz".format(root, data_type[0])))
+    assert(len(paths) > 0)
+    print('%s: scan %d samples with %d workers' % (datetime.now(), len(paths), num_worker))
+
+    jobs = [(paths[i:i+chunk], bins, hist_range, tuple(crop)) for i in range(0, len(paths), chunk)]
+    channels, hist, labels, windows = None, None, RunningStats(), RunningStats(shape=(2, 3))
+    pool = multiprocessing.Pool(max(num_worker, 1))
+    try:
+        for c, h, l, w in pool.imap_unordered(_sample_stats, jobs):
+            if channels is None:
+                channels, hist = c, h
+            else:
+                channels.merge(c)
+                hist += h
+            labels.merge(l)
+            windows.merge(w)
+    finally:
+        pool.close()
+        pool.join()
+
+    stats = {'num_samples': len(paths),
+             'channels': channels.to_dict(),
+             'histogram': {'bins': bins, 'range': list(hist_range), 'counts': hist.tolist(),
+                           'note': 'first/last count are values below/above the range'},
+             'y': labels.to_dict(),
+             'center': {'min': labels.min[3:6].tolist(), 'max': labels.max[3:6].tolist()},
+             'crop': {'size': list(crop),
+                      'min_start': windows.min[0].tolist(), 'max_stop': windows.max[1].tolist()}}
+    if os.path.exists(os.path.join(root, 'args.txt')):
+        args = read_args(root)
+        stats['params'] = {args['p%d' % i]: {'min': labels.min[i], 'max': labels.max[i]}
+                           for i in range(int(args['num_param']))}
+
+    range_path = os.path.join(root, data_type[0] + '_range.txt')
+    np.savetxt(range_path, [channels.min[0], channels.max[0]])
+    stats_path = os.path.join(root, data_type[0] + '_stats.json')
+    with open(stats_path, 'w') as f:
+        json.dump(stats, f, indent=2)
+    print('%s: x range [%g, %g], written to %s and %s' % (datetime.now(), channels.min[0], channels.max[0],
+                                                       range_path, stats_path))
+    return stats
+
+# input pipeline timing
+#
+# seconds and calls per stage and worker, summed between two reports. every report
+# appends one line to the jsonl log and returns the mean ms per call of each stage.
+
+STAGES = ['read', 'decompress', 'crop', 'normalize', 'load', 'enqueue', 'dequeue_wait']
+
+class PipelineStats(object):
+    def __init__(self, log_path=None):
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.totals = {} # worker -> stage -> [calls, seconds]
+        self.last = time.time()
+
+    @contextmanager
+    def timer(self, stage, worker=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start, worker)
+
+    def add(self, stage, seconds, worker=None, calls=1):
+        worker = worker or threading.current_thread().name
+        with self.lock:
+            t = self.totals.setdefault(worker, {}).setdefault(stage, [0, 0.])
+            t[0] += calls
+            t[1] += seconds
+
+    def merge(self, totals, prefix=''):
+        # totals of another process, as returned by take()
+        for worker, stages in totals.items():
+            for stage, (calls, seconds) in stages.items():
+                self.add(stage, seconds, prefix + worker, calls)
+
+    def take(self):
+        with self.lock:
+            totals, self.totals = self.totals, {}
+        return totals
+
+    def report(self):
+        totals = self.take()
+        now = time.time()
+        interval, self.last = now - self.last, now
+
+        stages = {}
+        for worker_stages in totals.values():
+            for stage, (calls, seconds) in worker_stages.items():
+                t = stages.setdefault(stage, [0, 0.])
+                t[0] += calls
+                t[1] += seconds
+        mean_ms = np.array([1000*stages[k][1]/stages[k][0] if k in stages else 0 for k in STAGES],
+                           dtype=np.float32)
+        if self.log_path is not None:
+            line = {'time': str(datetime.now()), 'interval': interval,
+                    # busy is seconds spent per second of wall time, summed over workers
+                    'stages': {k: {'calls': c, 'seconds': t, 'mean_ms': 1000*t/c, 'busy': t/interval}
+                               for k, (c, t) in stages.items()},
+                    'workers': {w: {k: {'calls': c, 'seconds': t} for k, (c, t) in ws.items()}
+                                for w, ws in totals.items()}}
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(line) + '\n')
+        return mean_ms
+
+if __name__ == "__main__":
+    from config import get_config
+    config, unparsed = get_config()
+
+    # python stats.py dataset --dataset ... --data_type ...
+    # python stats.py code [more shards] --code_path ... --z_num ...
+    # python stats.py unpack --code_path ... --z_num ...
+    cmd = unparsed[0] if unparsed else 'dataset'
+    if cmd == 'dataset':
+        root = os.path.join(config.data_dir, config.dataset)
+        dataset_stats(root, config.data_type, (config.res_z, config.res_y, config.res_x), config.num_worker)
+    elif cmd == 'code':
+        paths = [os.path.join(config.code_path, 'code%d.npz' % config.z_num)] + unparsed[1:]
+        for k, v in code_stats(paths).items():
+            print('%s: mean %g, std %g, min %g, max %g' % (k, v.mean, v.std, v.min, v.max))
+    elif cmd == 'unpack':
+        unpack_code(os.path.join(config.code_path, 'code%d.npz' % config.z_num))
+    else:
+        raise Exception("[!] Unknown stats command %s" % cmd)
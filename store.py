@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import multiprocessing
+from glob import glob
+from datetime import datetime
+from collections import OrderedDict
+
+import numpy as np
+
+def crop_slices(y, crop=(64,64,64), res=128, shift=None):
+    # window of size crop around the tumor center y[3:6] (given in [0,1] of the full res grid),
+    # res is the edge length of the full volume
+    c = [int(round(yi*res)) for yi in y[3:6]]
+    start = [ci-ki//2 for ci, ki in zip(c, crop)]
+    if shift is not None:
+        # a shifted window never reaches further outside of the grid than the centered one
+        start = [int(np.clip(si+di, min(si, 0), max(si, res-ki))) for si, di, ki in zip(start, shift, crop)]
+    return tuple(slice(si, si+ki//2*2) for si, ki in zip(start, crop))
+
+# packed, uncompressed sample store
+#
+# {root}/packed/{type}/x.npy     [N, z, y, x, 1] concentration
+#                      geom.npy  [N, z, y, x, 3] tissue probabilities
+#                      y.npy     [N, num_y]      raw labels (params + tumor center)
+#                      index.json
+#
+# all fields are opened with mmap, so a sample read is a page-cache lookup
+# instead of an open + zlib inflate, and loaders/concurrent runs share the pages.
+
+FIELDS = ['x', 'geom', 'y']
+
+class PackedStore(object):
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'index.json'), 'r') as f:
+            self.index = json.load(f)
+
+        self.row = {name: i for i, name in enumerate(self.index['paths'])}
+        self.fields = {}
+        for k in FIELDS:
+            self.fields[k] = np.load(os.path.join(store_dir, k+'.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index['paths'])
+
+    def sample(self, file_path):
+        # views into the mapped files, no data is copied here
+        i = self.row[os.path.basename(file_path)]
+        return self.fields['x'][i], self.fields['geom'][i], self.fields['y'][i]
+
+def _split_fields(data):
+    x = data['x']
+    return {'x': x[..., :1], 'geom': x[..., 1:], 'y': data['y']}
+
+def _pack_rows(job):
+    store_dir, rows = job
+    out = {k: np.load(os.path.join(store_dir, k+'.npy'), mmap_mode='r+') for k in FIELDS}
+    for i, path in rows:
+        with np.load(path) as data:
+            fields = _split_fields(data)
+            for k in FIELDS:
+                out[k][i] = fields[k]
+    for k in FIELDS:
+        out[k].flush()
+
+def pack_dataset(root, data_type, num_worker=1, chunk=64):
+    """convert {root}/{type}/*.npz into {root}/packed/{type}"""
+    paths = sorted(glob("{}/{}/*.npz".format(root, data_type[0])))
+    assert(len(paths) > 0)
+    store_dir = os.path.join(root, 'packed', data_type[0])
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    with np.load(paths[0]) as data:
+        fields = _split_fields(data)
+
+    print('%s: pack %d samples into %s' % (datetime.now(), len(paths), store_dir))
+    index = {'paths': [os.path.basename(p) for p in paths], 'fields': {}}
+    for k in FIELDS:
+        shape = (len(paths),) + fields[k].shape
+        index['fields'][k] = {'shape': list(shape), 'dtype': str(fields[k].dtype)}
+        m = np.lib.format.open_memmap(os.path.join(store_dir, k+'.npy'), mode='w+',
+                                      dtype=fields[k].dtype, shape=shape)
+        del m
+
+    rows = list(enumerate(paths))
+    jobs = [(store_dir, rows[i:i+chunk]) for i in range(0, len(rows), chunk)]
+    pool = multiprocessing.Pool(max(num_worker, 1))
+    try:
+        pool.map(_pack_rows, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    # written last, an interrupted conversion has no index
+    with open(os.path.join(store_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    print('%s: packing done' % datetime.now())
+    return store_dir
+
+def benchmark_read(root, data_type, num_samples=200, crop=(64,64,64), seed=123):
+    """samples/s and MB/s of cropped reads, per-file npz vs. packed store"""
+    store = PackedStore(os.path.join(root, 'packed', data_type[0]))
+    rng = np.random.RandomState(seed)
+    names = [store.index['paths'][i] for i in rng.randint(len(store), size=num_samples)]
+    paths = [os.path.join(root, data_type[0], n) for n in names]
+
+    def npz_read(path):
+        with np.load(path) as data:
+            y = data['y']
+            x = data['x']
+            return x[crop_slices(y, crop, x.shape[0])]
+
+    def packed_read(path):
+        x, geom, y = store.sample(path)
+        s = crop_slices(y, crop, x.shape[0])
+        # touch the data so the pages are actually read
+        return np.concatenate((x[s], geom[s]), axis=-1)
+
+    result = {}
+    for name, read in [('npz', npz_read), ('packed', packed_read)]:
+        nbytes = 0
+        start = time.time()
+        for path in paths:
+            nbytes += read(path).nbytes
+        elapsed = time.time() - start
+        result[name] = {'samples_per_sec': num_samples / elapsed,
+                        'mb_per_sec': nbytes / elapsed / 2**20}
+        print('%s: %d samples/s, %.1f MB/s' % (name, result[name]['samples_per_sec'],
+                                              result[name]['mb_per_sec']))
+    return result
+
+# deduplicated anatomy store
+#
+# {root}_dedup/{type}/name.npz   x [c, c, c, 1] cropped concentration, y, anatomy (id), window (crop start)
+#              anatomy/{id}.npy  [z, y, x, 3] tissue probabilities, id = content hash
+#
+# simulations of the same patient share one anatomy file instead of carrying
+# the full geometry in every sample.
+
+ANATOMY_CACHE_SIZE = 8 # decoded anatomies kept per process, 25 MB each at 128^3
+
+class AnatomyCache(object):
+    def __init__(self, anatomy_dir, capacity=ANATOMY_CACHE_SIZE):
+        self.anatomy_dir = anatomy_dir
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, anatomy_id):
+        with self.lock:
+            if anatomy_id in self.cache:
+                self.cache.move_to_end(anatomy_id)
+                return self.cache[anatomy_id]
+
+        # loaded outside of the lock, other loader threads keep going
+        geom = np.load(os.path.join(self.anatomy_dir, anatomy_id + '.npy'))
+        with self.lock:
+            self.cache[anatomy_id] = geom
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        return geom
+
+_anatomy_caches = {}
+_anatomy_lock = threading.Lock()
+
+def anatomy_cache(anatomy_dir):
+    # one cache per anatomy store and process
+    with _anatomy_lock:
+        if anatomy_dir not in _anatomy_caches:
+            _anatomy_caches[anatomy_dir] = AnatomyCache(anatomy_dir)
+        return _anatomy_caches[anatomy_dir]
+
+def anatomy_id(geom):
+    h = hashlib.sha1(str([geom.shape, geom.dtype.str]).encode())
+    h.update(np.ascontiguousarray(geom).data)
+    return h.hexdigest()[:16]
+
+def _dedup_sample(job):
+    src, dst, anatomy_dir, crop = job
+    with np.load(src) as data:
+        x = data['x']
+        y = data['y']
+    geom = x[..., 1:]
+    key = anatomy_id(geom)
+    anatomy_path = os.path.join(anatomy_dir, key + '.npy')
+    if not os.path.exists(anatomy_path):
+        # workers may race on the same anatomy, the rename makes the write atomic
+        tmp_path = '{}.{}.tmp.npy'.format(anatomy_path[:-4], os.getpid())
+        np.save(tmp_path, geom)
+        os.rename(tmp_path, anatomy_path)
+
+    s = crop_slices(y, crop, x.shape[0])
+    np.savez_compressed(dst, x=x[..., :1][s], y=y, anatomy=key,
+                        window=np.array([si.start for si in s] + list(crop)))
+    return key
+
+def dedup_dataset(root, data_type, crop, num_worker=1):
+    """convert {root} into {root}_dedup with one anatomy file per distinct geometry"""
+    out_root = root.rstrip('/') + '_dedup'
+    sample_dir = os.path.join(out_root, data_type[0])
+    anatomy_dir = os.path.join(out_root, 'anatomy')
+    for d in [sample_dir, anatomy_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    for name in ['args.txt', data_type[0]+'_range.txt']:
+        shutil.copy(os.path.join(root, name), os.path.join(out_root, name))
+
+    paths = sorted(glob("{}/{}/*.npz".format(root, data_type[0])))
+    print('%s: dedup %d samples into %s' % (datetime.now(), len(paths), out_root))
+    jobs = [(p, os.path.join(sample_dir, os.path.basename(p)), anatomy_dir, tuple(crop)) for p in paths]
+    pool = multiprocessing.Pool(max(num_worker, 1))
+    try:
+        keys = pool.map(_dedup_sample, jobs, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    print('%s: %d samples share %d anatomies' % (datetime.now(), len(keys), len(set(keys))))
+    return out_root
+
+def load_dedup(file_path, data, crop):
+    # concentration, raw y and the anatomy crop of a sample written by dedup_dataset
+    window = data['window']
+    assert(tuple(window[3:]) == tuple(crop)), 'dedup store was written for crop %s' % window[3:]
+    anatomy_dir = os.path.join(os.path.dirname(os.path.dirname(file_path)), 'anatomy')
+    geom = anatomy_cache(anatomy_dir).get(str(data['anatomy']))
+    s = tuple(slice(w, w+c) for w, c in zip(window[:3], crop))
+    return data['x'], data['y'], geom[s]
+
+if __name__ == "__main__":
+    from config import get_config
+    config, unparsed = get_config()
+    root = os.path.join(config.data_dir, config.dataset)
+    crop = (config.res_z, config.res_y, config.res_x)
+
+    # python store.py [pack|dedup] --dataset ...
+    cmd = unparsed[0] if unparsed else 'pack'
+    if cmd == 'pack':
+        pack_dataset(root, config.data_type, config.num_worker)
+        benchmark_read(root, config.data_type, crop=crop)
+    elif cmd == 'dedup':
+        dedup_dataset(root, config.data_type, crop, config.num_worker)
+    else:
+        raise Exception("[!] Unknown store command %s" % cmd)
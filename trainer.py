@@ -199,7 +199,9 @@ class Trainer(object):
             tf.summary.scalar("loss/g_loss_j_l1", self.g_loss_j_l1),
 
             tf.summary.scalar("misc/epoch", self.epoch),
-            tf.summary.scalar('misc/q', self.batch_manager.q.size()),
+            tf.summary.scalar('misc/q', self.batch_manager.queue_size()),
+            tf.summary.scalar('misc/q_fill', self.batch_manager.queue_fill()),
+            tf.summary.scalar('misc/skipped', self.batch_manager.skipped()),
 
             tf.summary.histogram("y", self.y),
 
@@ -218,6 +220,7 @@ class Trainer(object):
                 tf.summary.scalar("loss/d_loss_fake", tf.sqrt(self.d_loss_fake)),
             ]
 
+        summary += self.batch_manager.stats_summaries()
         self.summary_op = tf.summary.merge(summary)
         
         summary = [
@@ -412,7 +415,9 @@ class Trainer(object):
             tf.summary.scalar("loss/loss_p", self.loss_p),
 
             tf.summary.scalar("misc/epoch", self.epoch),
-            tf.summary.scalar('misc/q', self.batch_manager.q.size()),
+            tf.summary.scalar('misc/q', self.batch_manager.queue_size()),
+            tf.summary.scalar('misc/q_fill', self.batch_manager.queue_fill()),
+            tf.summary.scalar('misc/skipped', self.batch_manager.skipped()),
 
             tf.summary.histogram("y", y),
             tf.summary.histogram("z", self.z),
@@ -425,6 +430,7 @@ class Trainer(object):
                 tf.summary.scalar("loss/loss_kl", self.loss_kl),
             ]
 
+        summary += self.batch_manager.stats_summaries()
         self.summary_op = tf.summary.merge(summary)
 
     def train_ae(self):
@@ -710,13 +716,14 @@ class Trainer(object):
         num_frames = self.batch_manager.num_frames
 
         for i in range(num_sims):
-            z0 = self.batch_manager.x_test[i*(num_frames-1)]
+            x_test, y_test = self.batch_manager.test_rows(i*(num_frames-1), num_frames-1)
+            z0 = x_test[0]
             z_in = z0.reshape(1,-1)
             z_out = [z0[:-self.p_num].reshape(1,-1)*self.batch_manager.code_std]
             z_gt = [z0[:-self.p_num].reshape(1,-1)*self.batch_manager.code_std]
             for t in range(num_frames-1):
-                y_gt = self.batch_manager.y_test[i*(num_frames-1)+t]*self.batch_manager.out_std +\
-                    self.batch_manager.x_test[i*(num_frames-1)+t,:-self.p_num]*self.batch_manager.code_std
+                y_gt = y_test[t]*self.batch_manager.out_std +\
+                    x_test[t,:-self.p_num]*self.batch_manager.code_std
                 z_gt.append(y_gt.reshape(1, -1))
 
                 y_ = self.sess.run(self.y, {self.x: z_in})*self.batch_manager.out_std +\
@@ -725,7 +732,7 @@ class Trainer(object):
                 z_out.append(y_)
 
                 if t < num_frames-2:
-                    zt = self.batch_manager.x_test[i*(num_frames-1)+t+1]
+                    zt = x_test[t+1]
                     # z_in = self.batch_manager.x_test[i*149+t+1].reshape(1, -1) # gt..
                     z_in = np.append(y_.flatten()/self.batch_manager.code_std,zt[-self.p_num:]).reshape(1,-1)
 
@@ -53,18 +53,20 @@ class Trainer3(Trainer):
         self.g_loss_j_l1 = tf.reduce_mean(tf.abs(self.G_jaco_ - self.x_jaco))
         self.g_loss = self.g_loss_l1*self.w1 + self.g_loss_j_l1*self.w2
 
-        #validation losses
-        self.g_loss_l1_val = tf.reduce_mean(tf.abs(self.G_val - self.x_val))
-        self.g_loss_j_l1_val = tf.reduce_mean(tf.abs(self.G_jaco_val - self.x_jaco_val))
-        self.g_loss_val = self.g_loss_l1_val * self.w1 + self.g_loss_j_l1_val * self.w2
+        #validation losses, kept per sample so that the padded last validation batch can be trimmed
+        self.g_loss_l1_val = tf.reduce_mean(tf.abs(self.G_val - self.x_val), axis=[1,2,3,4])
+        self.g_loss_j_l1_val = tf.reduce_mean(tf.abs(self.G_jaco_val - self.x_jaco_val), axis=[1,2,3,4])
+        self.g_loss_val_samples = self.g_loss_l1_val * self.w1 + self.g_loss_j_l1_val * self.w2
 
         if self.phys_loss:
             print('debugging phyisics loss. G_, geom , y : ',self.G_,self.geom, self.y)
             self.loss_physics = self.construct_physics_loss(self.G_,self.geom, self.y)
             self.g_loss += 1. * self.loss_physics
 
-            self.loss_physics_val = self.construct_physics_loss(self.G_val, self.geom_val, self.y_val)
-            self.g_loss_val += 1. * self.loss_physics_val
+            self.loss_physics_val = self.construct_physics_loss(self.G_val, self.geom_val, self.y_val, per_sample=True)
+            self.g_loss_val_samples += 1. * self.loss_physics_val
+
+        self.g_loss_val = tf.reduce_mean(self.g_loss_val_samples)
 
         if 'dg' in self.arch:
             self.g_loss_real = tf.reduce_mean(tf.square(self.D_G-1))
@@ -96,7 +98,9 @@ class Trainer3(Trainer):
             tf.summary.scalar("loss/g_loss_j_l1", self.g_loss_j_l1),
 
             tf.summary.scalar("misc/epoch", self.epoch),
-            tf.summary.scalar('misc/q', self.batch_manager.q.size()),
+            tf.summary.scalar('misc/q', self.batch_manager.queue_size()),
+            tf.summary.scalar('misc/q_fill', self.batch_manager.queue_fill()),
+            tf.summary.scalar('misc/skipped', self.batch_manager.skipped()),
 
             tf.summary.histogram("y", self.y),
 
@@ -110,6 +114,7 @@ class Trainer3(Trainer):
                 tf.summary.scalar("loss/d_loss_fake", tf.sqrt(self.d_loss_fake)),
             ]
 
+        summary += self.batch_manager.stats_summaries()
         self.summary_op = tf.summary.merge(summary)
 
         # summary once
@@ -124,8 +129,11 @@ class Trainer3(Trainer):
         ]
         self.summary_once = tf.summary.merge(summary) # call just once
 
+        self.loss_val = tf.placeholder(tf.float32)
+        self.summary_val = tf.summary.scalar('validation_loss', self.loss_val)
+
 
-    def construct_physics_loss(self, concentration_output,brain_anatomy, parameters_input):
+    def construct_physics_loss(self, concentration_output,brain_anatomy, parameters_input, per_sample=False):
         """computes physics loss for batched data.
            expected input: concentration output : [B,X,Y,Z]
                            brain_anatomy: [B,X,Y,Z,C] , C = 3
@@ -135,22 +143,28 @@ class Trainer3(Trainer):
 
         with tf.variable_scope('physics_loss',reuse=False) as vs:
 
-            #TODO: right now dependant on parameter order in parameters_input. Could implement a more robust method using pname, see data.py
-            D_w = parameters_input[:,0]
-            rho = parameters_input[:,1]
-            #time = parameters_input[:,2]
-
-            rho = tf.reshape(rho,get_conv_shape(rho) + [1,1,1,1])
-
-            diffusion_term = tf.math.multiply(construct_diffusivity(brain_anatomy , D_w),laplacian3D(concentration_output))
-            proliferation_term = tf.math.multiply(rho, concentration_output)
-            proliferation_term = tf.math.multiply(proliferation_term, 1 - concentration_output) 
-            
-            temp1 = du_dt(concentration_output, parameters_input)  
-            print('debug.content of gradients is : ' + str(temp1))
-            temp2 = tf.math.add(tf.expand_dims(diffusion_term,-1),proliferation_term)
+            # back to physical units: parameters from their y_range, concentration from x_range
+            y_range = np.array(self.batch_manager.y_range, dtype=np.float32)
+            p = (parameters_input + 1) * 0.5 * (y_range[:,1] - y_range[:,0]) + y_range[:,0]
+            D_w = p[:,0]
+            rho = p[:,1]
+            if self.data_type[0] == 'd':
+                u, du_scale = (concentration_output + 1) * 0.5, 0.5
+            else:
+                u, du_scale = concentration_output * self.batch_manager.x_range, self.batch_manager.x_range
+            # d/dt of the normalized time is 2/(t_max-t_min) of d/dt in physical time
+            du_scale *= 2. / (y_range[2,1] - y_range[2,0])
+            spacing = float(getattr(self.batch_manager, 'args', {}).get('spacing', 1.))
+
+            num_ops = len(tf.get_default_graph().get_operations())
+            temp1 = du_dt(concentration_output, parameters_input) * du_scale
+            print('%s: du_dt added %d ops' % (datetime.now(), len(tf.get_default_graph().get_operations()) - num_ops))
+            temp2 = physics_residual(u, brain_anatomy, D_w, rho, spacing)
             temp1 = tf.squared_difference( temp1,temp2 )
-            loss = tf.reduce_mean(temp1)
+            if per_sample:
+                loss = tf.reduce_mean(temp1, axis=list(range(1, len(get_conv_shape(temp1)))))
+            else:
+                loss = tf.reduce_mean(temp1)
         return loss
 
     def train(self):
@@ -221,6 +235,7 @@ class Trainer3(Trainer):
 
         run_opts = tf.RunOptions(report_tensor_allocations_upon_oom=True)
 
+        last_step, last_time = self.start_step, time.time()
         for step in trange(self.start_step, self.max_step):
             if 'dg' in self.arch:
                 self.sess.run([self.g_optim, self.d_optim])
@@ -228,22 +243,29 @@ class Trainer3(Trainer):
                 self.sess.run(self.g_optim,options = run_opts)
 
             if step % self.log_step == 0 or step == self.max_step-1:
+                step_time = (time.time() - last_time) / max(step + 1 - last_step, 1)
+                print("\n[{}/{}] {:.3f} s/step".format(step, self.max_step, step_time))
                 ep = step*self.batch_manager.epochs_per_step
                 loss, summary = self.sess.run([self.g_loss,self.summary_op],
                                               feed_dict={self.epoch: ep},options = run_opts)
 
+                # exactly one pass over the validation set
+                self.batch_manager.start_validation()
                 loss_val = 0.
-                for _ in range(int(self.val_set_size /self.b_num)):
-                    loss_val  += self.sess.run(self.g_loss,
-                                              feed_dict={self.epoch: ep},options = run_opts)
-                loss_val /= int(self.val_set_size /self.b_num)
-                self.summary_writer.add_summary(self.sess.run(tf.summary.scalar('validation_loss', loss_val)), global_step= step)
+                for i in range(self.batch_manager.val_steps):
+                    l = self.sess.run(self.g_loss_val_samples, options = run_opts)
+                    if i == self.batch_manager.val_steps-1:
+                        l = l[:self.batch_manager.val_last]
+                    loss_val += np.sum(l)
+                loss_val /= self.val_set_size
+                self.summary_writer.add_summary(self.sess.run(self.summary_val, {self.loss_val: loss_val}), global_step= step)
 
                 assert not np.isnan(loss), 'Model diverged with loss = NaN'
                 print("\n[{}/{}/ep{:.2f}] Training Loss: {:.6f}".format(step, self.max_step, ep, loss))
                 print("\n[{}/{}/ep{:.2f}] Validation Loss: {:.6f}".format(step, self.max_step, ep, loss_val))
                 self.summary_writer.add_summary(summary, global_step=step)
                 self.summary_writer.flush()
+                last_step, last_time = step + 1, time.time()
 
             if step % self.test_step == 0 or step == self.max_step-1:
                 self.generate(z_samples,gen_list, self.model_dir, idx=step)
@@ -390,7 +412,9 @@ class Trainer3(Trainer):
             tf.summary.scalar("loss/loss_p", self.loss_p),
 
             tf.summary.scalar("misc/epoch", self.epoch),
-            tf.summary.scalar('misc/q', self.batch_manager.q.size()),
+            tf.summary.scalar('misc/q', self.batch_manager.queue_size()),
+            tf.summary.scalar('misc/q_fill', self.batch_manager.queue_fill()),
+            tf.summary.scalar('misc/skipped', self.batch_manager.skipped()),
 
             tf.summary.histogram("y", y),
             tf.summary.histogram("z", self.z),
@@ -403,6 +427,7 @@ class Trainer3(Trainer):
                 tf.summary.scalar("loss/loss_kl", self.loss_kl),
             ]
 
+        summary += self.batch_manager.stats_summaries()
         self.summary_op = tf.summary.merge(summary)
 
     def train_ae(self):